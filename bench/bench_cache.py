@@ -0,0 +1,268 @@
+"""
+benchmark the hot paths of the cache plugin.
+
+Measures ``config.cache`` get/set throughput for small and large values
+with each store backend, ``py.test --cache`` output over 10000 keys,
+``--lf`` and ``--ff`` item selection with 100000 collected items and
+10000 recorded failures, root directory resolution for many arguments
+in a deep tree and, with ``--startup``, the startup overhead measured by
+``bench_startup.py``.  Each benchmark reports the median of N rounds::
+
+    python bench/bench_cache.py [--rounds=N] [--codec=NAME] [--startup]
+                                [-k NAME] [--json=PATH] [--compare=PATH]
+
+``--json`` writes the results along with the interpreter and plugin
+version; ``--compare`` prints them next to the results of an earlier
+``--json`` run, e. g. from before a change.
+"""
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import py
+import pytest_cache
+from pytest_cache import Cache, LFPlugin, getrootdir, showcache
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+class Trace:
+    """ no-op stand-in for pytest's trace objects. """
+    def __call__(self, *args):
+        pass
+
+    def get(self, name):
+        return self
+
+    @property
+    def root(self):
+        return self
+
+
+class Hook:
+    def pytest_deselected(self, items):
+        pass
+
+
+class Option:
+    cacheslowest = 0
+
+
+class BenchConfig:
+    """ the parts of the pytest config object used by the plugin. """
+    trace = Trace()
+    hook = Hook()
+    inicfg = None
+    codec = "execnet"
+
+    def __init__(self, rootdir, args=(), ini=None, **values):
+        self.args = list(args) or [str(rootdir)]
+        self.ini = {"cache_backend": "dir", "cache_codec": self.codec,
+                    "cache_writer": "sync", "cache_remote": "",
+                    "cache_env": "", "cache_maxsize": ""}
+        self.ini.update(ini or {})
+        self.values = values
+        self.option = Option()
+
+    def getini(self, name):
+        return self.ini[name]
+
+    def getvalue(self, name):
+        return self.values.get(name)
+
+
+class Item:
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+
+
+def newproject():
+    project = py.path.local(tempfile.mkdtemp(prefix="bench-cache-"))
+    project.ensure("tox.ini")
+    return project
+
+
+def nodeids(n):
+    return ["tests/test_mod%d.py::TestClass::test_func%d" % (i // 100, i)
+            for i in range(n)]
+
+
+def bench_set_get(backend, value, n):
+    """ return setup functions for n sets plus a flush and n gets. """
+    def setup_set():
+        project = newproject()
+
+        def run():
+            cache = Cache(BenchConfig(project,
+                                      ini={"cache_backend": backend}))
+            for i in range(n):
+                cache.set("bench/key%d" % i, value)
+            cache.flush()
+        return run, project
+
+    def setup_get():
+        project = newproject()
+        config = BenchConfig(project, ini={"cache_backend": backend})
+        cache = Cache(config)
+        for i in range(n):
+            cache.set("bench/key%d" % i, value)
+        cache.flush()
+
+        def run():
+            cache = Cache(config)
+            for i in range(n):
+                assert cache.get("bench/key%d" % i, None) is not None
+        return run, project
+    return setup_set, setup_get
+
+
+def setup_showcache():
+    project = newproject()
+    config = BenchConfig(project)
+    cache = config.cache = Cache(config)
+    for i in range(10000):
+        cache.set("bench/key%d" % i, {"i": i, "ids": nodeids(3)})
+    cache.flush()
+
+    def run():
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            config.cache = Cache(config)
+            showcache(config, None)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return run, project
+
+
+def setup_modifyitems(option):
+    project = newproject()
+    ids = nodeids(100000)
+    config = BenchConfig(project, **{option: True})
+    config.cache = Cache(config)
+    config.cache.set("cache/lastfailed", set(ids[::10]))
+    config.cache.flush()
+    items = [Item(nodeid) for nodeid in ids]
+
+    def run():
+        config.cache = Cache(config)
+        plugin = LFPlugin(config)
+        plugin.pytest_collection_modifyitems(None, config, list(items))
+    return run, project
+
+
+def setup_getrootdir(inifile):
+    project = newproject()
+    if not inifile:
+        # all ancestors of all arguments are searched
+        project.join("tox.ini").remove()
+    deep = project.join(*["d%d" % i for i in range(40)])
+    args = [str(deep.ensure("test_%d.py" % i)) for i in range(2000)]
+    config = BenchConfig(project, args=args)
+
+    def run():
+        getrootdir(config, ".cache")
+    return run, project
+
+
+def benchmarks():
+    small = {"a": [1, 2, 3], "b": "text"}
+    large = nodeids(20000)
+    result = []
+    for backend in ("dir", "log"):
+        setup_set, setup_get = bench_set_get(backend, small, 2000)
+        result.append(("set 2000 small values (%s)" % backend, setup_set))
+        result.append(("get 2000 small values (%s)" % backend, setup_get))
+        setup_set, setup_get = bench_set_get(backend, large, 20)
+        result.append(("set 20 large values (%s)" % backend, setup_set))
+        result.append(("get 20 large values (%s)" % backend, setup_get))
+    result.append(("--cache with 10000 keys", setup_showcache))
+    result.append(("--lf 100000 items, 10000 failures",
+                   lambda: setup_modifyitems("lf")))
+    result.append(("--ff 100000 items, 10000 failures",
+                   lambda: setup_modifyitems("failedfirst")))
+    result.append(("getrootdir 2000 args, depth 40",
+                   lambda: setup_getrootdir(True)))
+    result.append(("getrootdir 2000 args, depth 40, no ini",
+                   lambda: setup_getrootdir(False)))
+    return result
+
+
+def timeit(setup, rounds):
+    timings = []
+    for i in range(rounds):
+        run, project = setup()
+        try:
+            start = clock()
+            run()
+            timings.append(clock() - start)
+        finally:
+            shutil.rmtree(str(project))
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(args):
+    rounds = 5
+    jsonpath = comparepath = keyword = None
+    startup = False
+    while args:
+        arg = args.pop(0)
+        if arg.startswith("--rounds="):
+            rounds = int(arg.split("=", 1)[1])
+        elif arg.startswith("--json="):
+            jsonpath = arg.split("=", 1)[1]
+        elif arg.startswith("--compare="):
+            comparepath = arg.split("=", 1)[1]
+        elif arg.startswith("--codec="):
+            BenchConfig.codec = arg.split("=", 1)[1]
+        elif arg == "--startup":
+            startup = True
+        elif arg == "-k":
+            keyword = args.pop(0)
+        else:
+            raise SystemExit(__doc__)
+    previous = {}
+    if comparepath:
+        previous = json.load(open(comparepath))["results"]
+    results = {}
+
+    def report(name, seconds):
+        results[name] = seconds
+        line = "%-40s %10.2f ms" % (name, seconds * 1000)
+        if name in previous:
+            line += " %10.2f ms %6.2fx" % (previous[name] * 1000,
+                                          previous[name] / seconds)
+        print(line)
+        sys.stdout.flush()
+
+    if comparepath:
+        print("%-40s %13s %13s %7s" % ("", "now", "before", "speedup"))
+    for name, setup in benchmarks():
+        if keyword is None or keyword in name:
+            report(name, timeit(setup, rounds))
+    if startup:
+        import bench_startup
+        for name, seconds in bench_startup.measure(rounds):
+            report(name, seconds)
+    if jsonpath:
+        with open(jsonpath, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "implementation": platform.python_implementation(),
+                       "platform": platform.platform(),
+                       "pytest_cache": pytest_cache.__version__,
+                       "rounds": rounds,
+                       "codec": BenchConfig.codec,
+                       "results": results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+measure the startup overhead the cache plugin adds to a test run.
+
+Runs ``py.test --collect-only`` on an empty project with the plugin
+enabled and disabled (``-p no:cacheprovider``) and reports the median
+wall time of each, as well as the import time of the plugin module.
+The plugin needs to be installed, e. g. with ``python setup.py develop``::
+
+    python bench/bench_startup.py [--rounds=N]
+
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLUGINDIR = os.path.dirname(HERE)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def timeit(args, cwd, rounds):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [PLUGINDIR] + env.get("PYTHONPATH", "").split(os.pathsep))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    timings = []
+    for i in range(rounds):
+        start = time.time()
+        popen = subprocess.Popen(args, cwd=cwd, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        out = popen.communicate()[0]
+        timings.append(time.time() - start)
+        # newer pytest releases exit with 5 if no tests were collected
+        if popen.returncode not in (0, 5):
+            raise SystemExit("%s failed:\n%s" % (" ".join(args), out))
+    return median(timings)
+
+
+def measure(rounds):
+    """ return ``(name, seconds)`` pairs of the startup timings. """
+    project = tempfile.mkdtemp(prefix="bench-startup-")
+    open(os.path.join(project, "tox.ini"), "w").close()
+    pytest = [sys.executable, "-m", "pytest", "--collect-only", "-q"]
+    results = [
+        ("import pytest", timeit(
+            [sys.executable, "-c", "import pytest"], project, rounds)),
+        ("import pytest, pytest_cache", timeit(
+            [sys.executable, "-c", "import pytest, pytest_cache"],
+            project, rounds)),
+        ("collect-only without plugin", timeit(
+            pytest + ["-p", "no:cacheprovider"], project, rounds)),
+        ("collect-only with plugin", timeit(
+            pytest, project, rounds)),
+    ]
+    shutil.rmtree(project)
+    return results
+
+
+def main(rounds):
+    results = measure(rounds)
+    for name, seconds in results:
+        print("%-32s %8.1f ms" % (name, seconds * 1000))
+    print("%-32s %8.1f ms" % (
+        "plugin import overhead", (results[1][1] - results[0][1]) * 1000))
+    print("%-32s %8.1f ms" % (
+        "plugin startup overhead", (results[3][1] - results[2][1]) * 1000))
+
+
+if __name__ == "__main__":
+    rounds = 10
+    for arg in sys.argv[1:]:
+        if arg.startswith("--rounds="):
+            rounds = int(arg.split("=", 1)[1])
+    main(rounds)
@@ -1,3 +1,12 @@
+import os
+import sys
+import array
+import copy
+import hashlib
+import shutil
+import struct
+import tempfile
+import time
 import py
 import pytest
 
@@ -8,119 +17,2608 @@ def pytest_addoption(parser):
     group = parser.getgroup("general")
     group.addoption('--lf', action='store_true', dest="lf",
         help="rerun tests that failed at the last run")
+    group.addoption('--ff', action='store_true', dest="failedfirst",
+        help="run all tests but run the last failures first")
+    group.addoption('--nf', action='store_true', dest="newfirst",
+        help="run all tests but run tests from new or modified files "
+             "first (after the last failures with --ff)")
+    group.addoption('--durations-order', action='store_true',
+        dest="durationsorder",
+        help="run the tests which took longest in recent runs first, "
+             "tests without recorded durations before all others")
+    group.addoption('--rerun-flaky', action='store', type="int",
+        dest="rerunflaky", default=0, metavar="N",
+        help="rerun failing tests up to N times if their outcome history "
+             "in cache/outcomes marks them as flaky")
+    group.addoption('--flaky-report', action='store_true',
+        dest="flakyreport",
+        help="show the failure rates of flaky tests over their last "
+             "runs; with --cache, without running tests")
+    group.addoption('--collect-cache', action='store_true',
+        dest="collectcache",
+        help="record the tests of each test file and, when selecting "
+             "with -k or -m, skip importing unchanged files without "
+             "selected tests")
+    group.addoption('--record-impact', action='store_true',
+        dest="recordimpact",
+        help="record which source files below the root directory each "
+             "test executes code from")
+    group.addoption('--changed', action='store_true', dest="changed",
+        help="run only tests which executed code from files changed "
+             "since their recording, new tests and the last failures "
+             "(implies --record-impact)")
     group.addoption('--cache', action='store_true', dest="showcache",
         help="show cache contents, don't perform collection or tests")
+    group.addoption('--cache-filter', action='store', dest="cachefilter",
+        metavar="PATTERN", default=None,
+        help="with --cache, only show keys and directories starting with "
+             "PATTERN or, if it contains *, ? or [, matching it as a glob")
+    group.addoption('--cache-values', action='store_true',
+        dest="cachevalues",
+        help="with --cache, show values and directory contents instead "
+             "of their size, codec and modification time only")
+    group.addoption('--cache-json', action='store_true', dest="cachejson",
+        help="with --cache, write one JSON object per key or directory")
+    group.addoption('--cache-slowest', action='store', type="int",
+        dest="cacheslowest", default=0, metavar="N",
+        help="with --cache, show the N slowest tests of recent runs")
+    group.addoption('--cache-stats', action='store_true', dest="cachestats",
+        help="show hits, misses, bytes and time spent per cache key "
+             "prefix in the terminal summary")
+    group.addoption('--cache-stats-json', action='store',
+        dest="cachestatsjson", metavar="PATH", default=None,
+        help="write the cache statistics as JSON to PATH at exit")
+    group.addoption('--cache-env', action='store', dest="cacheenv",
+        metavar="NAME", default=None,
+        help="keep cache values in a namespace for NAME and the python "
+             "interpreter, overriding the cache_env ini setting")
     group.addoption('--clearcache', action='store_true', dest="clearcache",
-        help="remove all cache contents at start of test run.")
+        help="remove all cache contents of the namespace at start of "
+             "test run.")
+    group.addoption('--clearcache-prefix', action='store',
+        dest="clearcacheprefix", metavar="PREFIX[,PREFIX]", default=None,
+        help="remove the cache values and directories whose names start "
+             "with one of the comma separated PREFIXes at start of test "
+             "run, e. g. 'cache/lastfailed'")
+    group.addoption('--cache-prune', action='store_true', dest="cacheprune",
+        help="remove expired cache entries and, beyond the cache_maxsize "
+             "ini setting, the least recently used ones; don't perform "
+             "collection or tests")
+    parser.addini("cache_backend", default="dir",
+        help="value store used by config.cache: 'dir' (one file per "
+             "key, the default) or 'log' (single append-only file)")
+    parser.addini("cache_codec", default="execnet",
+        help="serialization format for new cache values: 'execnet' (the "
+             "default), 'marshal' (fast, per python major version) or "
+             "'json' (human readable)")
+    parser.addini("cache_remote", default="",
+        help="URL of a cache server, e. g. 'http://cachehost:8765/myproj', "
+             "which values missing locally are fetched from and new "
+             "values are pushed to (see 'python -m pytest_cache --help')")
+    parser.addini("cache_writer", default="sync",
+        help="'sync' (the default) writes cache values when the session "
+             "finishes, 'thread' writes them from a background thread "
+             "while tests run")
+    parser.addini("cache_env", default="",
+        help="name of the test environment, e. g. of the tox env, which "
+             "cache values are kept apart for in addition to the python "
+             "interpreter")
+    parser.addini("cache_maxsize", default="",
+        help="size budget of the cache, e. g. '500M'; least recently "
+             "used values and directories are removed beyond it")
 
 
 def pytest_cmdline_main(config):
     if config.option.showcache:
         from _pytest.main import wrap_session
         return wrap_session(config, showcache)
+    if config.option.cacheprune:
+        from _pytest.main import wrap_session
+        return wrap_session(config, prunecache)
+
+# the keys read by the bundled plugins
+_pluginkeys = ["cache/lastfailed", "cache/mtimes", "cache/durations",
+               "cache/outcomes", "cache/collection", "cache/impact"]
+
+
+@pytest.mark.tryfirst
+def pytest_configure(config):
+    config.cache = cache = Cache(config)
+    # fetch what the plugins below read in one round trip
+    cache.prefetch(_pluginkeys)
+    config.pluginmanager.register(LFPlugin(config), "lfplugin")
+    config.pluginmanager.register(NFPlugin(config), "nfplugin")
+    # registered after NFPlugin so that its tryfirst reordering runs
+    # before those of the other plugins
+    config.pluginmanager.register(DurationsPlugin(config),
+                                  "durationsplugin")
+    config.pluginmanager.register(FlakyPlugin(config), "flakyplugin")
+    if config.getvalue("recordimpact") or config.getvalue("changed"):
+        config.pluginmanager.register(ImpactPlugin(config), "impactplugin")
+    if config.getvalue("collectcache"):
+        config.pluginmanager.register(CollectIndexPlugin(config),
+                                      "collectindexplugin")
+    if (config.pluginmanager.hasplugin("xdist") and
+            not hasattr(config, "slaveinput")):
+        config.pluginmanager.register(XdistCachePlugin(config),
+                                      "xdistcacheplugin")
+
+
+@pytest.mark.trylast
+def pytest_sessionfinish(session):
+    cache = session.config.cache
+    writer = cache._writer
+    if writer is not None and not writer.drain(writer.timeout):
+        # the rest is written by the flush at unconfigure
+        cache.trace("cache-writer busy after %ss" % (writer.timeout,))
+        return
+    cache.flush()
+
+
+def pytest_unconfigure(config):
+    _finalflush(config)
+    store = config.cache._storeobj
+    if hasattr(store, "wait") and not store.wait():
+        config.cache.trace("cache-remote push did not complete in time")
+    path = config.getvalue("cachestatsjson")
+    if path and not hasattr(config, "slaveinput"):
+        py.path.local(path).write(config.cache.stats.dumps(), "wb")
+
+
+def _finalflush(config):
+    """ flush the cache at exit, giving a background writer at most its
+    timeout, and return the keys of the writes dropped after it. """
+    writer = config.cache._writer
+    dropped = config.cache.flush(writer and writer.timeout)
+    if dropped:
+        _warn(config, "cache-writer busy after %ss, dropped writes of: %s"
+              % (writer.timeout, ", ".join(dropped)))
+    return dropped
+
+
+def _warn(config, message):
+    """ write ``message`` to the terminal, or stderr if there is none. """
+    terminal = config.pluginmanager.getplugin("terminalreporter")
+    if terminal is not None:
+        terminal.write_line("WARNING: %s" % (message,))
+    else:
+        sys.stderr.write("WARNING: %s\n" % (message,))
+
+
+def pytest_report_header(config):
+    if config.option.verbose:
+        relpath = py.path.local().bestrelpath(config.cache._cachedir)
+        return "cachedir: %s" % config.cache._cachedir
+
+
+def pytest_terminal_summary(terminalreporter):
+    if terminalreporter.config.getvalue("cachestats"):
+        terminalreporter.write_sep("-", "cache stats")
+        for line in terminalreporter.config.cache.stats.format():
+            terminalreporter.write_line(line)
+    stats = terminalreporter.config.cache._memostats
+    if stats:
+        terminalreporter.write_sep("-", "memoize")
+        for key in sorted(stats):
+            hits, misses = stats[key]
+            terminalreporter.write_line("%s: %d hits, %d misses" % (
+                key, hits, misses))
+
+
+def memoize_funcarg(key, deps=(), ttl=None):
+    """ return a decorator turning a ``pytest_funcarg__NAME(request)``
+    factory into one whose value is computed once per session and
+    memoized across sessions like :py:meth:`Cache.memoize` results::
+
+        @memoize_funcarg("myapp/db", deps=["schema.sql"])
+        def pytest_funcarg__db(request):
+            return build_database()
+    """
+    def decorator(func):
+        def factory(request):
+            cache = request.config.cache
+
+            def setup():
+                return cache._memoized(key, deps, ttl, ((), {}),
+                                       func, (request,), {})
+            return request.cached_setup(setup, scope="session",
+                                        extrakey=key)
+        factory.__name__ = func.__name__
+        factory.__doc__ = func.__doc__
+        return factory
+    return decorator
+
+
+_missing = object()
+
+
+class Cache(object):
+    def __init__(self, config):
+        self.config = config
+        self.trace = config.trace.root.get("cache")
+        self._values = {}
+        self._dirty = {}
+        self._codec = None
+        self._cachedirpath = None
+        self._namespace = None
+        # prefixes cleared in this process, not to be refetched from
+        # the cache_remote server
+        self._cleared = []
+        self._storeobj = None
+        # metadata index of sizes, access and expiry times, see _flushmeta
+        self._meta = None
+        self._blobmeta = None
+        self._metaupdates = {}
+        # hits and misses of memoize() per key, for the terminal summary
+        self._memostats = {}
+        self._depdigests = {}
+        self._writer = None
+        self.stats = CacheStats()
+        # values shipped by the master when running as a pytest-xdist
+        # slave, see XdistCachePlugin
+        slaveinput = getattr(config, "slaveinput", {})
+        self._snapshot = slaveinput.get("cache_snapshot")
+        # xdist slaves share the master's cache directory.  Cleared
+        # right away, before any value can be set, rather than when the
+        # directory is first needed
+        if not hasattr(config, "slaveinput"):
+            if config.getvalue("clearcache"):
+                self.trace("clearing cachedir")
+                self.clear()
+            prefixes = config.getvalue("clearcacheprefix")
+            for prefix in (prefixes or "").split(","):
+                if prefix:
+                    self.trace("clearing cache prefix %s" % (prefix,))
+                    self.clear(prefix)
+
+    @property
+    def _cachedir(self):
+        # resolved on first use so that runs which never touch the
+        # cache do not pay for the root directory search
+        if self._cachedirpath is None:
+            self._cachedirpath = getrootdir(self.config, ".cache")
+        return self._cachedirpath
+
+    @property
+    def namespace(self):
+        """ name of the namespace holding the values, directories and
+        metadata of this interpreter and the ``cache_env`` ini setting
+        or ``--cache-env`` option, e. g. ``cpython-2.7-lint``. """
+        if self._namespace is None:
+            self._namespace = getnamespace(self.config)
+        return self._namespace
+
+    @property
+    def _envdir(self):
+        # blobs, temporary files and the trash are shared by all
+        # namespaces and stay in the cache directory itself
+        return self._cachedir.join("env", self.namespace)
+
+    @property
+    def _store(self):
+        if self._storeobj is None:
+            store = getstore(self.config.getini("cache_backend"),
+                             self._envdir, self._cachedir.join("tmp"))
+            url = self.config.getini("cache_remote")
+            if url:
+                url = url.rstrip("/") + "/" + self.namespace
+                store = RemoteStore(store, url, self.trace,
+                                    cleared=self._cleared)
+            writer = self._getwriter()
+            if writer is not None:
+                store = _LockedStore(store, writer.lock)
+            self._storeobj = store
+        return self._storeobj
+
+    def _getwriter(self):
+        if self._writer is None and self._snapshot is None:
+            mode = self.config.getini("cache_writer")
+            if mode == "thread":
+                self._writer = BackgroundWriter(self)
+                self._store  # not to be set up by the writer thread
+            elif mode != "sync":
+                raise ValueError("unknown cache_writer %r (expected 'sync' "
+                                 "or 'thread')" % (mode,))
+        return self._writer
+
+    def _syncwriter(self, key):
+        """ wait for queued writes of ``key``, if any. """
+        if self._writer is not None and self._writer.pending(key):
+            self._writer.drain()
+
+    def deleteremote(self, keys):
+        """ delete the values for ``keys`` locally and from the
+        ``cache_remote`` server, if one is configured.  Pruning and
+        clearing only remove local values. """
+        if self._snapshot is not None:
+            raise ValueError("deleteremote() is not available on "
+                             "pytest-xdist slaves")
+        if self._writer is not None:
+            self._writer.drain()
+        for key in keys:
+            self._checkkey(key)
+            self._values.pop(key, None)
+            self._dirty.pop(key, None)
+            self._store.delete(key)
+        if self.config.getini("cache_remote"):
+            self._store.deleteremote(keys)
+
+    def prefetch(self, keys):
+        """ fetch the values of ``keys`` missing locally from the
+        ``cache_remote`` server, if one is configured, with as few
+        concurrent requests as possible.  Without prefetching, values
+        are fetched one at a time when they are first read. """
+        if self._snapshot is None and self.config.getini("cache_remote"):
+            self._store.prefetch(keys)
+
+    def _getcodec(self):
+        if self._codec is None:
+            self._codec = getcodec(self.config.getini("cache_codec"))
+        return self._codec
+
+    def makedir(self, name, ttl=None):
+        """ return a directory path object with the given name.  If the
+        directory does not yet exist, it will be created.  You can use it
+        to manage files likes e. g. store/retrieve database
+        dumps across test sessions.
+
+        :param name: must be a string not containing a ``/`` separator.
+             Make sure the name contains your plugin or application
+             identifiers to prevent clashes with other cache users.
+        :param ttl: if given, the directory is emptied ``ttl`` seconds
+             after it was created.
+        """
+        if name.count("/") != 0:
+            raise ValueError("name is not allowed to contain '/'")
+        p = self._envdir.join("d/" + name)
+        now = time.time()
+        entry = self._getmeta()["dirs"].get(name)
+        expires = entry and entry[2]
+        if expires is not None and expires <= now and p.check():
+            self.trace("cache-expired directory %s" % (name,))
+            p.remove()
+            expires = None
+        if not p.check(dir=1):
+            p.ensure(dir=1)
+            expires = None
+        if ttl is not None and expires is None:
+            self._touch("dirs", name, expires=now + ttl)
+        else:
+            self._touch("dirs", name)
+        return p
+
+    def mapfile(self, path):
+        """ return a read-only buffer memory-mapping the file at ``path``,
+        which must live in a directory returned by :py:meth:`makedir`.
+
+        Unlike reading the file, this does not copy its content into
+        process memory, so many processes can share large files.
+        """
+        path = py.path.local(path)
+        if not path.relto(self._envdir.join("d")):
+            raise ValueError("%s is not in a cache directory" % (path,))
+        return _mapfile(path, 0, path.size())
+
+    def openwriter(self, key):
+        """ return a binary file-like object for streaming a large value
+        into the cache.  The value replaces any previous value for
+        ``key`` once the writer is closed; used as a context manager, it
+        is discarded instead if the block raises an exception.
+
+        The value can be read back, without loading it into memory, with
+        :py:meth:`openbuffer`, or as a bytes object with :py:meth:`get`.
+        """
+        self._checkkey(key)
+        tmpdir = self._cachedir.join("tmp")
+        tmpdir.ensure(dir=1)
+        fd, name = tempfile.mkstemp(dir=str(tmpdir))
+        os.close(fd)
+
+        def commit(tmppath):
+            self._values.pop(key, None)
+            self._dirty.pop(key, None)
+            size = tmppath.size()
+            self._touch("values", key, size=size, expires=None)
+            start = _clock()
+            self._store.commitfile(key, tmppath)
+            self.stats.add(key, "io_time", _clock() - start)
+            self.stats.add(key, "bytes_written", size)
+        return ValueWriter(py.path.local(name), commit)
+
+    def openbuffer(self, key):
+        """ return a read-only memory-mapped buffer of the value written
+        for ``key`` with :py:meth:`openwriter`, or None if there is no
+        value.  Raises ValueError for values stored with :py:meth:`set`.
+        """
+        self._checkkey(key)
+        self._syncwriter(key)
+        if key in self._dirty:
+            self.flush()
+        location = self._store.locate(key)
+        if location is None:
+            return None
+        path, offset, length = location
+        f = path.open("rb")
+        try:
+            f.seek(offset)
+            head = f.read(len(_valuemagic) + 2)
+        finally:
+            f.close()
+        if peekcodec(head) != (RawCodec, len(head)):
+            raise ValueError("%s was not written with openwriter()" % key)
+        return _mapfile(path, offset + len(head), length - len(head))
+
+    def putblob(self, source):
+        """ store the content of ``source``, a file path or a binary
+        file-like object, as a blob and return its hex digest.
+
+        Blobs are addressed by their content, so storing the same
+        content again, e. g. from another plugin or branch, takes no
+        additional space.  Use :py:meth:`linkblob` to place a blob in a
+        working directory.
+        """
+        if hasattr(source, "read") and not isinstance(source, py.path.local):
+            f = source
+        else:
+            f = open(str(source), "rb")
+        tmpdir = self._cachedir.join("tmp")
+        tmpdir.ensure(dir=1)
+        fd, name = tempfile.mkstemp(dir=str(tmpdir))
+        hasher = hashlib.sha1()
+        size = 0
+        try:
+            out = os.fdopen(fd, "wb")
+            try:
+                while 1:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+            finally:
+                out.close()
+                if f is not source:
+                    f.close()
+            digest = hasher.hexdigest()
+            path = self._blobpath(digest)
+            if not path.check(file=1):
+                # blobs are shared by hardlinks, guard against edits
+                os.chmod(name, 0o444)
+                path.dirpath().ensure(dir=1)
+                _replace(name, path)
+                self.trace("cache-blob %s: %d bytes" % (digest, size))
+        finally:
+            if os.path.exists(name):
+                os.remove(name)
+        self._touch("blobs", digest, size=size)
+        return digest
+
+    def getblob(self, digest):
+        """ return the path of the blob with the given digest, or None if
+        there is no such blob.  The file must not be modified. """
+        path = self._blobpath(digest)
+        if not path.check(file=1):
+            return None
+        self._touch("blobs", digest)
+        return path
+
+    def linkblob(self, digest, target, writable=False):
+        """ place the blob with the given digest at ``target``, replacing
+        any file there, and return the target path, or None if there is
+        no such blob.
+
+        The blob is hardlinked, which takes neither time nor space but
+        leaves a read-only file which must not be modified.  With
+        ``writable=True`` a writable copy is made instead, cloned
+        copy-on-write on filesystems supporting it.  Blobs are copied
+        if they cannot be linked, e. g. across filesystems.
+        """
+        blob = self.getblob(digest)
+        if blob is None:
+            return None
+        target = py.path.local(target)
+        if target.check():
+            target.remove()
+        target.dirpath().ensure(dir=1)
+        _linkfile(blob, target, writable)
+        return target
+
+    def puttree(self, path):
+        """ store all files below the directory ``path`` as blobs and
+        return the digest of a blob listing them, for restoring the
+        directory with :py:meth:`linktree`. """
+        path = py.path.local(path)
+        manifest = []
+        for dirpath, dirnames, filenames in os.walk(str(path)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                p = py.path.local(dirpath).join(filename)
+                executable = bool(p.stat().mode & 0o100)
+                manifest.append([p.relto(path).replace(os.sep, "/"),
+                                 self.putblob(p), executable])
+        from io import BytesIO
+        data = encodevalue({"tree": manifest}, JSONCodec)
+        return self.putblob(BytesIO(data))
+
+    def linktree(self, digest, target, writable=False):
+        """ restore a directory stored with :py:meth:`puttree` at
+        ``target``, replacing it, and return the target path, or None if
+        the tree or one of its files is no longer in the cache.  Files
+        are placed as described for :py:meth:`linkblob`. """
+        blob = self.getblob(digest)
+        if blob is None:
+            return None
+        try:
+            manifest = decodevalue(blob.read("rb"))["tree"]
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("blob %s is not a tree" % (digest,))
+        for relpath, filedigest, executable in manifest:
+            if not self._blobpath(filedigest).check(file=1):
+                return None
+        target = py.path.local(target)
+        if target.check():
+            target.remove()
+        target.ensure(dir=1)
+        for relpath, filedigest, executable in manifest:
+            # blobs are stored read-only, executables need their own copy
+            p = self.linkblob(filedigest, target.join(relpath),
+                              writable or executable)
+            if executable:
+                p.chmod(p.stat().mode | 0o111)
+        return target
+
+    def _blobpath(self, digest):
+        if len(digest) != 40 or digest.strip("0123456789abcdef"):
+            raise ValueError("invalid blob digest %r" % (digest,))
+        return self._cachedir.join("b", digest[:2], digest[2:])
+
+    def _checkkey(self, key):
+        if not key.count("/") > 0:
+            raise KeyError("Key must be of format 'dir/.../subname")
+
+    def _getvaluepath(self, key):
+        self._checkkey(key)
+        p = self._store.path(key)
+        p.dirpath().ensure(dir=1)
+        return p
+
+    def get(self, key, default):
+        """ return cached value for the given key.  If no value
+        was yet cached or the value cannot be read, the specified
+        default is returned.
+
+        :param key: must be a ``/`` separated value. Usually the first
+             name is the name of your plugin or your application.
+        :param default: must be provided in case of a cache-miss or
+             invalid cache values.
+
+        """
+        try:
+            value = self._values[key]
+        except KeyError:
+            self._syncwriter(key)
+            value = self._load(key)
+            self._values[key] = value
+        if value is _missing:
+            self.stats.add(key, "misses")
+            return default
+        self.stats.add(key, "hits")
+        return copy.deepcopy(value)
+
+    def _load(self, key, fresh=False):
+        """ return the value of ``key`` or ``_missing``; with ``fresh``,
+        values written by other processes since they were last read,
+        e. g. while holding the key lock, are seen. """
+        self._checkkey(key)
+        entry = self._getmeta()["values"].get(key)
+        if entry is not None and entry[2] is not None \
+                and entry[2] <= time.time():
+            self.trace("cache-expired %s" % (key,))
+            return _missing
+        if self._snapshot is not None and key in self._snapshot:
+            data = self._snapshot[key]
+        else:
+            start = _clock()
+            if fresh:
+                data = self._store.readfresh(key)
+            else:
+                data = self._store.read(key)
+            self.stats.add(key, "io_time", _clock() - start)
+        if data is not None:
+            self._touch("values", key, size=len(data))
+            self.stats.add(key, "bytes_read", len(data))
+            start = _clock()
+            try:
+                return decodevalue(data)
+            except ValueError:
+                self.trace("cache-invalid at %s" % (key,))
+                self.stats.add(key, "invalid")
+            finally:
+                self.stats.add(key, "serialize_time", _clock() - start)
+        return _missing
+
+    def update(self, key, func, default):
+        """ atomically replace the value for ``key`` with ``func(value)``
+        and return the new value.
+
+        ``value`` is the current value on disk, or ``default``.  Other
+        processes updating the same key concurrently are serialized by
+        a per-key file lock, so no update is lost; unlike :py:meth:`set`
+        the new value is written to disk immediately.
+        """
+        self._checkkey(key)
+        if self._snapshot is not None:
+            # xdist slave, the master stores the result
+            value = func(self.get(key, default))
+            self.set(key, value)
+            return value
+        self._syncwriter(key)
+        value = self._applyupdate(key, func, default)
+        self._values[key] = copy.deepcopy(value)
+        return value
+
+    def _applyupdate(self, key, func, default):
+        with self._keylock(key):
+            if key in self._dirty:
+                # set here or merged from a slave, not yet on disk
+                value = self._values.get(key, _missing)
+                if value is _missing:
+                    value = decodevalue(self._dirty[key])
+            else:
+                value = self._load(key, fresh=True)
+            if value is _missing:
+                value = default
+            value = func(copy.deepcopy(value))
+            data = self._encode(key, value)
+            self.trace("cache-update %s: %d bytes" % (key, len(data)))
+            self._writeitems([(key, data)])
+            self._dirty.pop(key, None)
+        self._touch("values", key, size=len(data))
+        return value
+
+    def _updatelater(self, key, func, default):
+        """ like :py:meth:`update`, but done by the background writer if
+        there is one. """
+        if self._snapshot is not None or self._getwriter() is None:
+            self.update(key, func, default)
+        else:
+            self._checkkey(key)
+            self._values.pop(key, None)
+            self._writer.update(key, func, default)
+
+    def _keylock(self, key):
+        return FileLock(self._envdir.join(
+            "locks", hashlib.sha1(key.encode("utf-8")).hexdigest()))
+
+    def memoize(self, key, deps=(), ttl=None):
+        """ return a decorator caching the results of a function.
+
+        Results are stored below ``key`` for each combination of the
+        function's arguments, which must be basic python types, and of
+        the content of the ``deps`` files, given relative to the root
+        directory; changing any of these files computes a new result.
+        Results are computed under a lock, so processes calling the
+        function concurrently with the same arguments, e. g.
+        pytest-xdist slaves, compute them only once.
+
+        :param ttl: if given, results expire after ``ttl`` seconds.
+        """
+        self._checkkey(key)
+
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                return self._memoized(key, deps, ttl, (args, kwargs),
+                                      func, args, kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def _memoized(self, key, deps, ttl, arguments, func, args, kwargs):
+        args_, kwargs_ = arguments
+        hasher = hashlib.sha1(encodevalue(
+            _canonical((list(args_), kwargs_)), ExecnetCodec))
+        root = self._cachedir.dirpath()
+        for dep in deps:
+            hasher.update(self._depdigest(root.join(dep, abs=1)).encode())
+        fullkey = "%s/%s" % (key, hasher.hexdigest())
+        stats = self._memostats.setdefault(key, [0, 0])
+        value = self._values.get(fullkey, _missing)
+        if value is _missing:
+            with self._keylock(fullkey):
+                value = self._load(fullkey, fresh=True)
+                if value is _missing:
+                    stats[1] += 1
+                    self.stats.add(fullkey, "misses")
+                    value = func(*args, **kwargs)
+                    data = self._encode(fullkey, value)
+                    self.trace("cache-memoize %s: %d bytes" % (
+                        fullkey, len(data)))
+                    # written right away, other processes wait for it
+                    self._writeitems([(fullkey, data)])
+                    self._values[fullkey] = copy.deepcopy(value)
+                    expires = ttl is not None and time.time() + ttl or None
+                    self._touch("values", fullkey, size=len(data),
+                                expires=expires)
+                    return value
+            self._values[fullkey] = value
+        stats[0] += 1
+        self.stats.add(fullkey, "hits")
+        return copy.deepcopy(value)
+
+    def _depdigest(self, path):
+        """ return the content digest of a memoize() dependency, hashing
+        each file once per process unless it changes. """
+        try:
+            st = path.stat()
+        except py.error.ENOENT:
+            return "missing"
+        sig = (st.mtime, st.size)
+        cached = self._depdigests.get(path)
+        if cached is None or cached[0] != sig:
+            cached = self._depdigests[path] = (sig, _filedigest(path))
+        return cached[1]
+
+    def set(self, key, value, ttl=None):
+        """ save value for the given key.
+
+        :param key: must be a ``/`` separated value. Usually the first
+             name is the name of your plugin or your application.
+        :param value: must be of any combination of basic
+               python types, including nested types
+               like e. g. lists of dictionaries.
+        :param ttl: if given, the value expires after ``ttl`` seconds
+               and is then treated as missing.
+
+        The value is written to disk by :py:meth:`flush`, at the
+        latest when the test session finishes.  Use :py:meth:`update`
+        to merge with values written concurrently by other processes.
+        """
+        self._checkkey(key)
+        data = self._encode(key, value)
+        self._values[key] = copy.deepcopy(value)
+        writer = self._getwriter()
+        if writer is not None:
+            self._dirty.pop(key, None)
+            writer.put(key, data)
+        else:
+            self._dirty[key] = data
+        expires = ttl is not None and time.time() + ttl or None
+        self._touch("values", key, size=len(data), expires=expires)
+
+    def flush(self, timeout=None):
+        """ write all values set since the last flush to disk.
+
+        This happens automatically at the end of the test session;
+        call it if another process needs to see the values earlier.
+        On pytest-xdist slaves the values are instead handed to the
+        master at the end of the session.
+
+        With ``cache_writer = thread`` and a ``timeout``, pending writes
+        are waited for at most ``timeout`` seconds.  Writes still pending
+        then are dropped and their keys returned.
+        """
+        dropped = []
+        if self._flush(timeout, dropped) and not dropped:
+            maxsize = _parsesize(self.config.getini("cache_maxsize"))
+            if maxsize is not None and (
+                    _metasize(self._meta or {}) > maxsize or
+                    _metasize(self._blobmeta or {}) > maxsize):
+                self._prune(maxsize)
+        return dropped
+
+    def _flush(self, timeout=None, dropped=None):
+        """ write values and the metadata index, return True if the
+        latter was written.  Keys of writes given up after ``timeout``
+        are appended to ``dropped``. """
+        if self._snapshot is not None:
+            # xdist slave, the master writes values and metadata
+            output = self.config.slaveoutput
+            output.setdefault("cache_updates", {}).update(self._dirty)
+            output.setdefault("cache_meta", {}).update(self._metaupdates)
+            output["cache_memostats"] = self._memostats
+            output["cache_stats"] = self.stats.prefixes
+            self._dirty.clear()
+            self._metaupdates = {}
+            return False
+        if self._writer is not None and not self._writer.drain(timeout):
+            keys = self._writer.abandon()
+            for key in keys:
+                self._metaupdates.pop(("values", key), None)
+            if dropped is not None:
+                dropped.extend(keys)
+        if self._dirty:
+            self._writeitems(sorted(self._dirty.items()))
+            self._dirty.clear()
+        if self._metaupdates:
+            self._flushmeta()
+            return True
+        return False
+
+    def _encode(self, key, value):
+        start = _clock()
+        try:
+            return encodevalue(value, self._getcodec())
+        finally:
+            self.stats.add(key, "serialize_time", _clock() - start)
+
+    def _writeitems(self, items):
+        """ write ``(key, data)`` pairs to the store in one batch. """
+        if not items:
+            return
+        for key, data in items:
+            self.trace("cache-write %s: %d bytes" % (key, len(data)))
+        start = _clock()
+        self._store.writemany(items)
+        elapsed = _clock() - start
+        # the batch's time is shared out by size
+        total = sum([len(data) for key, data in items]) or 1
+        for key, data in items:
+            self.stats.add(key, "bytes_written", len(data))
+            self.stats.add(key, "io_time", elapsed * len(data) / total)
+
+    def _getmeta(self):
+        if self._meta is None:
+            self._meta = self._readmeta()
+        return self._meta
+
+    def _readmeta(self, path=None):
+        """ return the metadata index mapping the keys of values and the
+        names of directories to ``[size, atime, expires]`` lists.
+
+        The index of the namespace is kept in its ``meta`` file.  Blobs
+        are shared by all namespaces, so their index is kept in
+        ``.cache/blobmeta`` instead, see :py:meth:`_metapath`.
+        """
+        meta = {}
+        data = path or self._envdir.join("meta")
+        if data.check(file=1):
+            try:
+                meta = decodevalue(data.read("rb"))
+            except ValueError:
+                self.trace("cache-invalid metadata")
+        for kind in ("values", "dirs", "blobs"):
+            meta.setdefault(kind, {})
+        return meta
+
+    def _metapath(self, kind):
+        if kind == "blobs":
+            return self._cachedir.join("blobmeta")
+        return self._envdir.join("meta")
+
+    def _touch(self, kind, name, size=None, expires=_missing):
+        """ note an access to the value (kind ``"values"``), directory
+        (``"dirs"``) or blob (``"blobs"``) ``name`` for the metadata
+        index. """
+        update = self._metaupdates.get((kind, name)) or {}
+        update["atime"] = time.time()
+        if size is not None:
+            update["size"] = size
+        if expires is not _missing:
+            update["expires"] = expires
+        self._metaupdates[(kind, name)] = update
+
+    def _flushmeta(self):
+        """ merge the noted accesses into the metadata indexes on disk. """
+        updates, self._metaupdates = self._metaupdates, {}
+        ddir = self._envdir.join("d")
+        byindex = {}
+        for (kind, name), update in updates.items():
+            if kind == "dirs":
+                update["size"] = _dirsize(ddir.join(name))
+            byindex.setdefault(kind == "blobs", []).append(
+                (kind, name, update))
+        for shared, items in sorted(byindex.items()):
+            path = self._metapath(shared and "blobs" or "values")
+            with FileLock(path.new(basename=path.basename + ".lock")):
+                meta = self._readmeta(path)
+                for kind, name, update in items:
+                    entries = meta[kind]
+                    size, atime, expires = (entries.get(name) or
+                                            (None, 0, None))
+                    entries[name] = [update.get("size", size),
+                                     update.get("atime", atime),
+                                     update.get("expires", expires)]
+                self._writemeta(meta, path)
+
+    def _writemeta(self, meta, path=None):
+        path = path or self._envdir.join("meta")
+        _writefile(path, encodevalue(meta, self._getcodec()),
+                   self._cachedir.join("tmp"))
+        if path == self._envdir.join("meta"):
+            self._meta = meta
+        else:
+            self._blobmeta = meta
+
+    def prune(self, maxsize=None):
+        """ remove expired values and directories and, while the
+        namespace is larger than ``maxsize`` bytes, the least recently
+        used values and directories.  Blobs, which all namespaces share,
+        are removed least recently used first while they take up more
+        than ``maxsize`` bytes together.
+
+        Return a list of ``(kind, name, size)`` tuples for the removed
+        entries, with kind being ``"values"``, ``"dirs"`` or ``"blobs"``.
+        Only the metadata indexes are consulted; entries written before
+        they existed are indexed when pruning for the first time.
+        """
+        self._flush()
+        return self._prune(maxsize)
+
+    def _prune(self, maxsize):
+        removed = []
+        for kinds in (("values", "dirs"), ("blobs",)):
+            path = self._metapath(kinds[0])
+            with FileLock(path.new(basename=path.basename + ".lock")):
+                meta = self._readmeta(path)
+                if not meta.get("indexed"):
+                    self._indexmeta(meta, kinds)
+                removed.extend(self._evict(meta, kinds, maxsize))
+                self._writemeta(meta, path)
+        return removed
+
+    def _evict(self, meta, kinds, maxsize):
+        """ remove the expired and, beyond ``maxsize``, least recently
+        used entries of ``kinds`` in ``meta``. """
+        now = time.time()
+        ddir = self._envdir.join("d")
+        entries = []
+        for kind in kinds:
+            for name, (size, atime, expires) in meta[kind].items():
+                entries.append((atime, kind, name, size or 0, expires))
+        entries.sort()
+        total = _metasize(meta, kinds)
+        removed = []
+        for atime, kind, name, size, expires in entries:
+            if ((expires is not None and expires <= now) or
+                    (maxsize is not None and total > maxsize)):
+                removed.append((kind, name, size))
+                total -= size
+        for kind, name, size in removed:
+            self.trace("cache-prune %s %s" % (kind, name))
+            if kind == "values":
+                self._store.delete(name)
+                self._values.pop(name, None)
+            elif kind == "blobs":
+                # hardlinked copies of the blob stay intact
+                if self._blobpath(name).check():
+                    self._blobpath(name).remove()
+            elif ddir.join(name).check():
+                ddir.join(name).remove()
+            del meta[kind][name]
+        return removed
+
+    def clear(self, prefix=None):
+        """ remove the values whose keys start with ``prefix`` and the
+        :py:meth:`makedir` directories whose names start with it, or,
+        without a prefix, all cache contents.
+
+        Directories are renamed aside and removed by a background
+        thread, so clearing large caches returns right away.  Only the
+        local cache is cleared: the values on a ``cache_remote`` server
+        stay in place but are not fetched again by this process.
+        """
+        if self._writer is not None:
+            self._writer.drain()
+        self._cleared.append(prefix or "")
+        trash = []
+        if prefix is None:
+            self._values.clear()
+            self._dirty.clear()
+            self._metaupdates = {}
+            if self._envdir.check(dir=1):
+                trash.extend([p for p in self._envdir.listdir()
+                              if p.basename != "journal"])
+            # journals locked by running sessions, this one included,
+            # stay in place
+            OutcomeJournal(self).discard()
+            # the log store and the metadata index are reread
+            self._storeobj = None
+            self._meta = None
+        else:
+            for key in list(self._values) + list(self._dirty):
+                if key.startswith(prefix):
+                    self._values.pop(key, None)
+                    self._dirty.pop(key, None)
+            for kind, name in list(self._metaupdates):
+                if kind != "blobs" and name.startswith(prefix):
+                    del self._metaupdates[(kind, name)]
+            trash.extend(self._store.clear(prefix))
+            ddir = self._envdir.join("d")
+            if ddir.check(dir=1):
+                for p in ddir.listdir():
+                    if p.basename.startswith(prefix):
+                        trash.append(p)
+            if "cache/lastfailed".startswith(prefix):
+                # or the journals of killed sessions bring failures back
+                OutcomeJournal(self).discard()
+        for p in trash:
+            self._trash(p)
+        if prefix is not None and self._envdir.join("meta").check():
+            with FileLock(self._envdir.join("meta.lock")):
+                meta = self._readmeta()
+                for kind in ("values", "dirs"):
+                    for name in list(meta[kind]):
+                        if name.startswith(prefix):
+                            del meta[kind][name]
+                self._writemeta(meta)
+        _emptytrash(self._cachedir.join("trash"))
+
+    def _trash(self, path):
+        """ move ``path`` below ``.cache/trash`` for removal by
+        :py:func:`_emptytrash`. """
+        trashdir = self._cachedir.join("trash")
+        trashdir.ensure(dir=1)
+        target = py.path.local(tempfile.mkdtemp(dir=str(trashdir)))
+        try:
+            path.rename(target.join(path.basename))
+        except EnvironmentError:
+            # e. g. files opened on windows, remove them in place
+            self.trace("cache-trash failed to move %s" % (path,))
+            path.remove(ignore_errors=True)
+
+    def _indexmeta(self, meta, kinds):
+        """ add entries of ``kinds`` missing in ``meta``. """
+        if "values" in kinds:
+            for key in self._store.keys():
+                if key not in meta["values"]:
+                    location = self._store.locate(key)
+                    if location is not None:
+                        meta["values"][key] = [location[2], 0, None]
+        ddir = self._envdir.join("d")
+        if "dirs" in kinds and ddir.check(dir=1):
+            for p in ddir.listdir():
+                if p.basename not in meta["dirs"]:
+                    meta["dirs"][p.basename] = [_dirsize(p), 0, None]
+        bdir = self._cachedir.join("b")
+        if "blobs" in kinds and bdir.check(dir=1):
+            for p in bdir.visit(lambda p: p.check(file=1)):
+                digest = p.dirpath().basename + p.basename
+                if digest not in meta["blobs"]:
+                    meta["blobs"][digest] = [p.size(), 0, None]
+        meta["indexed"] = True
+
+    def _getsnapshot(self, keys, maxsize, maxtotal):
+        """ return a dict mapping those of ``keys`` which have a value to
+        their serialized values, leaving out values larger than
+        ``maxsize`` bytes and the ones exceeding ``maxtotal`` bytes in
+        all.  Values not yet flushed are written first, so that all
+        other values can be read from disk. """
+        self._flush()
+        snapshot = {}
+        total = 0
+        for key in keys:
+            location = self._store.locate(key)
+            if (location is None or location[2] > maxsize or
+                    total + location[2] > maxtotal):
+                continue
+            data = self._store.read(key)
+            if data is not None:
+                snapshot[key] = data
+                total += len(data)
+        return snapshot
+
+    def _merge(self, updates):
+        """ take over serialized values, to be written by the next flush. """
+        for key, data in updates.items():
+            try:
+                self._values[key] = decodevalue(data)
+            except ValueError:
+                self.trace("cache-invalid at %s" % (key,))
+                continue
+            self._dirty[key] = data
+            self._touch("values", key, size=len(data))
+
+    def _mergeslave(self, slaveoutput):
+        """ take over values, metadata and memoize() statistics handed
+        back by an xdist slave. """
+        self._merge(slaveoutput.get("cache_updates", {}))
+        for (kind, name), update in slaveoutput.get("cache_meta",
+                                                    {}).items():
+            self._metaupdates.setdefault((kind, name), {}).update(update)
+        for key, (hits, misses) in slaveoutput.get("cache_memostats",
+                                                   {}).items():
+            stats = self._memostats.setdefault(key, [0, 0])
+            stats[0] += hits
+            stats[1] += misses
+        self.stats.merge(slaveoutput.get("cache_stats", {}))
+
+
+_clock = getattr(time, "perf_counter", time.time)
+
+
+class CacheStats:
+    """ counters of cache activity per key prefix, the part of the key
+    before its last ``/``.  Times are in seconds. """
+    fields = ("hits", "misses", "invalid", "bytes_read", "bytes_written",
+              "serialize_time", "io_time")
+
+    def __init__(self):
+        self.prefixes = {}
+
+    def add(self, key, field, amount=1):
+        prefix = key.rsplit("/", 1)[0]
+        counters = self.prefixes.get(prefix)
+        if counters is None:
+            counters = self.prefixes[prefix] = dict.fromkeys(self.fields, 0)
+        counters[field] += amount
+
+    def merge(self, prefixes):
+        """ add the counters of another process. """
+        for prefix, counters in prefixes.items():
+            for field, amount in counters.items():
+                self.add(prefix + "/", field, amount)
+
+    def format(self):
+        """ return lines of a table of the counters. """
+        lines = ["%-19s %6s %6s %7s %9s %9s %8s %8s" % (
+            "prefix", "hits", "misses", "invalid", "read", "written",
+            "ser (ms)", "io (ms)")]
+        for prefix in sorted(self.prefixes):
+            c = self.prefixes[prefix]
+            lines.append("%-19s %6d %6d %7d %9d %9d %8.1f %8.1f" % (
+                prefix, c["hits"], c["misses"], c["invalid"],
+                c["bytes_read"], c["bytes_written"],
+                c["serialize_time"] * 1000, c["io_time"] * 1000))
+        return lines
+
+    def dumps(self):
+        import json
+        return json.dumps({"prefixes": self.prefixes}, sort_keys=True,
+                          indent=1).encode("utf-8")
+
+
+def _emptytrash(trashdir):
+    """ remove the contents of ``trashdir`` in a background thread.
+
+    The thread is not a daemon so that the interpreter waits for it at
+    exit; contents left behind by killed processes are removed the next
+    time the cache is cleared.
+    """
+    import threading
+    if not trashdir.check(dir=1):
+        return
+    paths = [str(p) for p in trashdir.listdir()]
+    if not paths:
+        return
+
+    def remove():
+        for path in paths:
+            shutil.rmtree(path, True)
+    thread = threading.Thread(target=remove, name="pytest-cache-trash")
+    thread.start()
+    return thread
+
+
+def _metasize(meta, kinds=("values", "dirs", "blobs")):
+    return sum([entry[0] or 0 for kind in kinds
+                for entry in meta.get(kind, {}).values()])
+
+
+def _dirsize(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return size
+
+
+def _parsesize(text):
+    """ return the number of bytes in ``text`` like '20M', or None. """
+    text = text.strip().upper()
+    if not text:
+        return None
+    factor = 1
+    for suffix, multiplier in (("K", 2 ** 10), ("M", 2 ** 20),
+                               ("G", 2 ** 30)):
+        if text.endswith(suffix):
+            text, factor = text[:-1], multiplier
+    try:
+        return int(float(text) * factor)
+    except ValueError:
+        raise ValueError("invalid cache_maxsize %r" % (text,))
+
+
+def getstore(backend, cachedir, tmpdir=None):
+    """ return the value store named ``backend`` rooted at ``cachedir``,
+    writing temporary files to ``tmpdir`` or ``cachedir/tmp``. """
+    if backend == "dir":
+        return DirectoryStore(cachedir.join("v"),
+                              tmpdir or cachedir.join("tmp"))
+    elif backend == "log":
+        return LogStore(cachedir.join("values.log"))
+    raise ValueError("unknown cache_backend %r (expected 'dir' or 'log')"
+                     % (backend,))
+
+
+### value serialization
+
+_py3 = sys.version_info[0] >= 3
+try:
+    _text, _long = unicode, long
+except NameError:
+    _text, _long = str, int
+_valuemagic = b"PYTC"
+_valueversion = b"\x01"
+
+
+def encodevalue(value, codec):
+    """ return ``value`` serialized with ``codec`` behind a header naming
+    the format version and codec.  Sets of test ids always use the
+    compact :py:class:`NodeidSetCodec`. """
+    if NodeidSetCodec.accepts(value):
+        codec = NodeidSetCodec
+    try:
+        payload = codec.resolve().dumps(value)
+    except ValueError:
+        raise ValueError("cannot serialize a builtin python type")
+    return _valuemagic + _valueversion + codec.id + payload
+
+
+def decodevalue(data):
+    """ return the value serialized in ``data``; raise ValueError if it
+    cannot be decoded.  Data without a header was written by earlier
+    releases and is decoded with execnet. """
+    codec, offset = peekcodec(data)
+    return codec.resolve().loads(data[offset:])
+
+
+def peekcodec(data):
+    """ return the codec of serialized ``data`` and the offset of its
+    payload without decoding it. """
+    if data[:len(_valuemagic)] != _valuemagic:
+        return ExecnetCodec, 0
+    offset = len(_valuemagic)
+    if data[offset:offset + 1] != _valueversion:
+        raise ValueError("unsupported cache value format")
+    codec = _codecsbyid.get(data[offset + 1:offset + 2])
+    if codec is None:
+        raise ValueError("unknown cache value codec")
+    return codec, offset + 2
+
+
+class ValueWriter(object):
+    """ binary file-like object streaming a value into the cache,
+    see :py:meth:`Cache.openwriter`. """
+    def __init__(self, tmppath, commit):
+        self._tmppath = tmppath
+        self._commit = commit
+        self._file = tmppath.open("wb")
+        self._file.write(_valuemagic + _valueversion + RawCodec.id)
+        self.closed = False
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+            self._commit(self._tmppath)
+
+    def discard(self):
+        if not self.closed:
+            self.closed = True
+            self._file.close()
+            self._tmppath.remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _mapfile(path, offset, length):
+    import mmap
+    if length == 0:
+        return _buffer(b"", 0, 0)
+    f = path.open("rb")
+    try:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    return _buffer(mapped, offset, length)
+
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, length):
+        return memoryview(obj)[offset:offset + length]
+
+
+def _replace(src, dst):
+    """ rename ``src`` to ``dst``, replacing ``dst`` on all platforms. """
+    try:
+        os.rename(str(src), str(dst))
+    except OSError:
+        if sys.platform != "win32" or not os.path.exists(str(dst)):
+            raise
+        os.remove(str(dst))
+        os.rename(str(src), str(dst))
+
+
+def getcodec(name):
+    """ return the codec registered under ``name``, its serializer
+    imported once so that encoding and decoding run no imports. """
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError("unknown cache_codec %r (expected one of %s)"
+                         % (name, ", ".join(sorted(codecs))))
+    return codec.resolve()
+
+
+class ExecnetCodec:
+    """ execnet's dumps/loads format, readable by all interpreters. """
+    name = "execnet"
+    id = b"e"
+    _dumps = _loads = _error = None
+
+    @classmethod
+    def resolve(cls):
+        """ import execnet on first use rather than on every call. """
+        if cls._error is None:
+            from execnet import dumps, loads, DataFormatError
+            cls._dumps = staticmethod(dumps)
+            cls._loads = staticmethod(loads)
+            cls._error = DataFormatError
+        return cls
+
+    @classmethod
+    def dumps(cls, value):
+        try:
+            return cls._dumps(value)
+        except cls._error:
+            raise ValueError("cannot serialize %r" % (type(value),))
+
+    @classmethod
+    def loads(cls, data):
+        try:
+            return cls._loads(data)
+        except cls._error:
+            raise ValueError("invalid execnet data")
+
+
+class MarshalCodec:
+    """ the interpreter's marshal format.  Much faster than execnet, but
+    values written under one python major version read as invalid (and
+    thus as a cache miss) under another one. """
+    name = "marshal"
+    id = b"m"
+    _tag = struct.pack("B", sys.version_info[0])
+    _marshal = None
+
+    @classmethod
+    def resolve(cls):
+        if cls._marshal is None:
+            import marshal
+            cls._marshal = marshal
+        return cls
+
+    @classmethod
+    def dumps(cls, value):
+        return cls._tag + cls._marshal.dumps(value, 2)
+
+    @classmethod
+    def loads(cls, data):
+        if data[:1] != cls._tag:
+            raise ValueError("marshal data of another python version")
+        try:
+            return cls._marshal.loads(data[1:])
+        except (EOFError, TypeError):
+            raise ValueError("invalid marshal data")
+
+
+class JSONCodec:
+    """ JSON text so that values can be read with any editor.  Tuples,
+    sets, bytes and dicts with non-string keys are written as single-key
+    objects tagged with the type name. """
+    name = "json"
+    id = b"j"
+    _tags = ("__tuple__", "__set__", "__frozenset__", "__bytes__",
+             "__dict__")
+    _json = None
+
+    @classmethod
+    def resolve(cls):
+        if cls._json is None:
+            import json
+            cls._json = json
+        return cls
+
+    @classmethod
+    def dumps(cls, value):
+        return cls._json.dumps(cls._tojson(value), sort_keys=True,
+                               indent=1).encode("utf-8")
+
+    @classmethod
+    def loads(cls, data):
+        return cls._json.loads(data.decode("utf-8"),
+                               object_hook=cls._fromjson)
+
+    @classmethod
+    def _tojson(cls, obj):
+        if obj is None or isinstance(obj, (bool, int, _long, float, _text)):
+            return obj
+        elif isinstance(obj, bytes):
+            if not _py3:  # a native string
+                return obj
+            import base64
+            return {"__bytes__": base64.b64encode(obj).decode("ascii")}
+        elif isinstance(obj, list):
+            return [cls._tojson(x) for x in obj]
+        elif isinstance(obj, tuple):
+            return {"__tuple__": [cls._tojson(x) for x in obj]}
+        elif isinstance(obj, (set, frozenset)):
+            items = list(obj)
+            try:
+                items.sort()
+            except TypeError:
+                pass
+            tag = "__%s__" % type(obj).__name__
+            return {tag: [cls._tojson(x) for x in items]}
+        elif isinstance(obj, dict):
+            if (all(isinstance(k, (str, _text)) for k in obj) and
+                    not (len(obj) == 1 and list(obj)[0] in cls._tags)):
+                return dict((k, cls._tojson(v)) for k, v in obj.items())
+            return {"__dict__": [[cls._tojson(k), cls._tojson(v)]
+                                 for k, v in obj.items()]}
+        raise ValueError("cannot serialize %r" % (type(obj),))
+
+    @staticmethod
+    def _fromjson(obj):
+        if len(obj) == 1:
+            tag, value = list(obj.items())[0]
+            if tag == "__tuple__":
+                return tuple(value)
+            elif tag == "__set__":
+                return set(value)
+            elif tag == "__frozenset__":
+                return frozenset(value)
+            elif tag == "__bytes__":
+                import base64
+                return base64.b64decode(value.encode("ascii"))
+            elif tag == "__dict__":
+                return dict((_hashable(k), v) for k, v in value)
+        return obj
+
+
+def _canonical(obj):
+    """ return ``obj`` with sets and dicts replaced by tagged tuples of
+    their sorted items, so that equal values serialize alike whatever
+    their iteration order. """
+    if isinstance(obj, list):
+        return [_canonical(x) for x in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_canonical(x) for x in obj)
+    elif isinstance(obj, (set, frozenset, dict)):
+        if isinstance(obj, dict):
+            items = [(_canonical(k), _canonical(v)) for k, v in obj.items()]
+        else:
+            items = [_canonical(x) for x in obj]
+        # sorted by their serialization, values of mixed types included
+        items.sort(key=ExecnetCodec.resolve().dumps)
+        return ("__%s__" % type(obj).__name__, tuple(items))
+    return obj
+
+
+def _hashable(obj):
+    if isinstance(obj, list):
+        return tuple(obj)
+    return obj
+
+
+class NodeidSetCodec:
+    """ compact encoding for sets of strings such as test ids.
+
+    The sorted strings are front coded: each one is stored as the
+    length of the prefix it shares with its predecessor followed by the
+    remaining suffix.  Test ids share long file and class prefixes, so
+    this is several times smaller and faster to decode than a generic
+    format.
+    """
+    name = "nodeids"
+    id = b"s"
+
+    @classmethod
+    def resolve(cls):
+        return cls
+
+    @staticmethod
+    def accepts(value):
+        return (type(value) in (set, frozenset) and
+                all(type(x) is str for x in value))
+
+    @staticmethod
+    def dumps(value):
+        out = bytearray(b"f" if type(value) is frozenset else b"s")
+        if _py3:
+            items = sorted(x.encode("utf-8") for x in value)
+        else:
+            items = sorted(value)
+        _writevarint(out, len(items))
+        prev = b""
+        for item in items:
+            shared = len(os.path.commonprefix([prev, item]))
+            _writevarint(out, shared)
+            _writevarint(out, len(item) - shared)
+            out += item[shared:]
+            prev = item
+        return bytes(out)
+
+    @staticmethod
+    def loads(data):
+        buf = bytearray(data)
+        try:
+            kind = bytes(buf[:1])
+            count, pos = _readvarint(buf, 1)
+            items = []
+            prev = b""
+            for i in range(count):
+                shared, pos = _readvarint(buf, pos)
+                length, pos = _readvarint(buf, pos)
+                if shared > len(prev) or pos + length > len(buf):
+                    raise ValueError("truncated")
+                item = prev[:shared] + bytes(buf[pos:pos + length])
+                pos += length
+                items.append(item)
+                prev = item
+        except IndexError:
+            raise ValueError("truncated nodeid set")
+        if pos != len(buf) or kind not in (b"s", b"f"):
+            raise ValueError("invalid nodeid set")
+        if _py3:
+            items = [x.decode("utf-8") for x in items]
+        if kind == b"f":
+            return frozenset(items)
+        return set(items)
+
+
+class RawCodec:
+    """ uninterpreted bytes, as written by :py:meth:`Cache.openwriter`. """
+    name = "raw"
+    id = b"r"
+
+    @classmethod
+    def resolve(cls):
+        return cls
+
+    @staticmethod
+    def dumps(value):
+        if not isinstance(value, bytes):
+            raise ValueError("raw values must be bytes")
+        return value
+
+    @staticmethod
+    def loads(data):
+        return bytes(data)
+
+
+def _writevarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _readvarint(buf, pos):
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+codecs = dict((c.name, c) for c in (ExecnetCodec, MarshalCodec, JSONCodec))
+_codecsbyid = dict((c.id, c) for c in
+                   list(codecs.values()) + [NodeidSetCodec, RawCodec])
+
+
+class FileLock(object):
+    """ exclusive lock between processes, held on the file at ``path``.
+
+    The lock file is created on demand and left in place, removing it
+    would race with processes waiting for the lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        """ acquire the lock and return True, or return False if
+        ``blocking`` is false and another process holds it. """
+        self.path.dirpath().ensure(dir=1)
+        f = open(str(self.path), "a+b")
+        try:
+            if not _lockfile(f, blocking):
+                f.close()
+                return False
+        except:
+            f.close()
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        f, self._file = self._file, None
+        if f is not None:
+            _unlockfile(f)
+            f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+try:
+    import fcntl
+except ImportError:  # windows
+    import msvcrt
+
+    def _lockfile(f, blocking):
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                return True
+            except IOError:
+                if not blocking:
+                    return False
+                time.sleep(0.05)
+
+    def _unlockfile(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    def _lockfile(f, blocking):
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except IOError:
+            if blocking:
+                raise
+            return False
+        return True
+
+    def _unlockfile(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _linkfile(src, dst, writable):
+    """ hardlink ``src`` to ``dst`` or, if ``writable`` or linking is not
+    possible, copy it. """
+    if not writable:
+        try:
+            os.link(str(src), str(dst))
+            return
+        except (AttributeError, OSError):
+            pass  # not supported by the platform or across filesystems
+    fsrc = open(str(src), "rb")
+    try:
+        fdst = open(str(dst), "wb")
+        try:
+            if not _clonefile(fsrc, fdst):
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+
+_FICLONE = 0x40049409
+
+
+def _clonefile(fsrc, fdst):
+    """ make ``fdst`` a copy-on-write clone of ``fsrc`` where the
+    filesystem supports it (btrfs, xfs), return True on success. """
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _writefile(path, data, tmpdir):
+    """ write ``data`` to ``path`` by renaming a complete temporary file
+    from ``tmpdir`` over it, so that readers never see partial data. """
+    tmpdir.ensure(dir=1)
+    fd, name = tempfile.mkstemp(dir=str(tmpdir))
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        path.dirpath().ensure(dir=1)
+        _replace(name, path)
+    except:
+        if os.path.exists(name):
+            os.remove(name)
+        raise
+
+
+class DirectoryStore:
+    """ value store keeping one file per key below ``basedir``.
+
+    This is the ``.cache/v`` layout of earlier releases.  Values are
+    written to temporary files in ``tmpdir`` first and then renamed
+    into place.
+    """
+    def __init__(self, basedir, tmpdir):
+        self.basedir = basedir
+        self.tmpdir = tmpdir
+
+    def path(self, key):
+        return self.basedir.join(key)
+
+    def keys(self):
+        if not self.basedir.check(dir=1):
+            return []
+        paths = self.basedir.visit(lambda x: x.check(file=1))
+        return sorted([p.relto(self.basedir).replace(os.sep, "/")
+                       for p in paths])
+
+    def iterkeys(self, prefix=""):
+        """ yield the keys starting with ``prefix``, sorted per directory,
+        only listing the directories such keys can be in. """
+        return self._iterkeys(str(self.basedir), "", prefix)
+
+    def _iterkeys(self, path, base, prefix):
+        try:
+            names = sorted(os.listdir(path))
+        except EnvironmentError:
+            return
+        for name in names:
+            key = base + name
+            if not key.startswith(prefix) and \
+                    not prefix.startswith(key + "/"):
+                continue
+            p = os.path.join(path, name)
+            if os.path.isdir(p):
+                for key in self._iterkeys(p, key + "/", prefix):
+                    yield key
+            else:
+                yield key
+
+    def mtime(self, key):
+        try:
+            return self.path(key).mtime()
+        except EnvironmentError:
+            return None
+
+    def read(self, key):
+        try:
+            f = self.path(key).open("rb")
+        except EnvironmentError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    # every read sees the files written by other processes
+    readfresh = read
+
+    def locate(self, key):
+        path = self.path(key)
+        try:
+            return path, 0, path.size()
+        except EnvironmentError:
+            return None
+
+    def writemany(self, items):
+        for key, data in items:
+            self.write(key, data)
+
+    def commitfile(self, key, tmppath):
+        path = self.path(key)
+        path.dirpath().ensure(dir=1)
+        _replace(tmppath, path)
+
+    def write(self, key, data):
+        _writefile(self.path(key), data, self.tmpdir)
+
+    def delete(self, key):
+        path = self.path(key)
+        if path.check():
+            path.remove()
+
+    def clear(self, prefix):
+        """ remove the keys starting with ``prefix`` and return the
+        directories holding only such keys, for the caller to remove. """
+        return self._clear(self.basedir, "", prefix)
+
+    def _clear(self, path, base, prefix):
+        dirs = []
+        try:
+            names = sorted(os.listdir(str(path)))
+        except EnvironmentError:
+            return dirs
+        for name in names:
+            key = base + name
+            p = path.join(name)
+            if p.check(dir=1):
+                if (key + "/").startswith(prefix):
+                    dirs.append(p)
+                elif prefix.startswith(key + "/"):
+                    dirs.extend(self._clear(p, key + "/", prefix))
+            elif key.startswith(prefix):
+                p.remove()
+        return dirs
+
+
+class LogStore:
+    """ value store keeping all keys in a single append-only log file.
+
+    The log is scanned once to build an in-memory index mapping keys to
+    value offsets, so a lookup costs one seek and read instead of a
+    stat and open per key.  Writes append a record which supersedes
+    earlier records for the same key; the file is compacted once
+    superseded records outweigh live ones.  Appending and compacting
+    happen under a file lock so several processes can share the log.
+    """
+    magic = b"PYTCLOG1"
+    header = struct.Struct("<Hqd")  # key length, value length, mtime
+    compact_threshold = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = FileLock(path.new(basename=path.basename + ".lock"))
+        self._index = None
+        self._inode = None
+        self._end = 0
+        self._garbage = 0
+
+    def _getindex(self):
+        if self._index is None:
+            self._index = {}
+            self._scan()
+        return self._index
+
+    def _scan(self):
+        """ index records from the last scanned position to the end,
+        starting over if another process compacted the log. """
+        try:
+            f = self.path.open("rb")
+        except EnvironmentError:
+            return
+        try:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode:
+                self._index.clear()
+                self._inode = stat.st_ino
+                self._end = self._garbage = 0
+            if self._end == 0:
+                if f.read(len(self.magic)) != self.magic:
+                    return
+                self._end = len(self.magic)
+            f.seek(self._end)
+            index = self._index
+            while True:
+                head = f.read(self.header.size)
+                if len(head) < self.header.size:
+                    break
+                keylen, vallen, mtime = self.header.unpack(head)
+                key = f.read(keylen)
+                offset = f.tell()
+                if len(key) < keylen or offset + vallen > stat.st_size:
+                    break  # truncated record, e. g. from a killed writer
+                key = key.decode("utf-8")
+                old = index.pop(key, None)
+                if old is not None:
+                    self._garbage += old[1]
+                if vallen >= 0:
+                    index[key] = (offset, vallen, mtime)
+                    f.seek(vallen, 1)
+                self._end = f.tell()
+        finally:
+            f.close()
+
+    def _record(self, key, vallen, mtime):
+        key = key.encode("utf-8")
+        return self.header.pack(len(key), vallen, mtime) + key
+
+    def keys(self):
+        return sorted(self._getindex())
+
+    def iterkeys(self, prefix=""):
+        for key in self.keys():
+            if key.startswith(prefix):
+                yield key
+
+    def mtime(self, key):
+        entry = self._getindex().get(key)
+        return entry and entry[2]
+
+    def locate(self, key):
+        self._getindex()
+        self._scan()
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        return self.path, entry[0], entry[1]
+
+    def read(self, key):
+        entry = self._getindex().get(key)
+        if entry is None:
+            return None
+        offset, vallen, mtime = entry
+        f = self.path.open("rb")
+        try:
+            if os.fstat(f.fileno()).st_ino != self._inode:
+                self._scan()  # compacted, offsets have changed
+                return self.read(key)
+            f.seek(offset)
+            return f.read(vallen)
+        finally:
+            f.close()
+
+    def readfresh(self, key):
+        """ like :py:meth:`read`, but first index the records appended
+        by other processes since the last scan. """
+        self._getindex()
+        self._scan()
+        return self.read(key)
+
+    def write(self, key, data):
+        self._append([(key, data)])
+
+    def writemany(self, items):
+        self._append(items)
+
+    def delete(self, key):
+        if key in self._getindex():
+            self._append([(key, None)])
+
+    def clear(self, prefix):
+        """ remove the keys starting with ``prefix`` in a single append. """
+        keys = list(self.iterkeys(prefix))
+        if keys:
+            self._append([(key, None) for key in keys])
+        return []
+
+    def commitfile(self, key, tmppath):
+        vallen = tmppath.size()
+        with self.lock:
+            f = self._openlog()
+            try:
+                mtime = time.time()
+                head = self._record(key, vallen, mtime)
+                f.write(head)
+                src = tmppath.open("rb")
+                try:
+                    shutil.copyfileobj(src, f, 1024 * 1024)
+                finally:
+                    src.close()
+            finally:
+                f.close()
+            tmppath.remove()
+            self._indexed(key, vallen, mtime, len(head) + vallen)
+            self._maybecompact()
+
+    def _append(self, items):
+        """ append one record per ``(key, data)`` pair in a single write,
+        ``None`` data marks a deleted key. """
+        with self.lock:
+            f = self._openlog()
+            try:
+                mtime = time.time()
+                records = []
+                for key, data in items:
+                    if data is None:
+                        records.append(self._record(key, -1, mtime))
+                    else:
+                        records.append(self._record(key, len(data), mtime))
+                        records.append(data)
+                f.write(b"".join(records))
+            finally:
+                f.close()
+            for key, data in items:
+                vallen = -1 if data is None else len(data)
+                recordlen = len(self._record(key, vallen, mtime))
+                self._indexed(key, vallen, mtime,
+                              recordlen + max(vallen, 0))
+            self._maybecompact()
+
+    def _openlog(self):
+        """ open the log for appending after the last intact record. """
+        self._getindex()
+        self._scan()  # pick up records appended by other processes
+        self.path.dirpath().ensure(dir=1)
+        f = self.path.open("ab")
+        try:
+            if self._end == 0:
+                f.truncate(0)
+                f.write(self.magic)
+                self._end = len(self.magic)
+                self._inode = os.fstat(f.fileno()).st_ino
+            elif os.fstat(f.fileno()).st_size != self._end:
+                f.truncate(self._end)  # drop a truncated tail record
+        except:
+            f.close()
+            raise
+        return f
+
+    def _indexed(self, key, vallen, mtime, recordlen):
+        self._end += recordlen
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._garbage += old[1]
+        if vallen >= 0:
+            self._index[key] = (self._end - vallen, vallen, mtime)
+
+    def _maybecompact(self):
+        if self._garbage > max(self.compact_threshold, self._end // 2):
+            self._compact()
+
+    def compact(self):
+        """ rewrite the log keeping only the live record of each key. """
+        with self.lock:
+            self._getindex()
+            self._scan()
+            self._compact()
+
+    def _compact(self):
+        tmp = self.path.new(basename=self.path.basename + ".tmp")
+        newindex = {}
+        src = self.path.open("rb")
+        try:
+            dst = tmp.open("wb")
+            try:
+                dst.write(self.magic)
+                for key in sorted(self._index):
+                    offset, vallen, mtime = self._index[key]
+                    dst.write(self._record(key, vallen, mtime))
+                    newindex[key] = (dst.tell(), vallen, mtime)
+                    src.seek(offset)
+                    _copybytes(src, dst, vallen)
+                end = dst.tell()
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        _replace(tmp, self.path)
+        self._index = newindex
+        self._inode = os.stat(str(self.path)).st_ino
+        self._end = end
+        self._garbage = 0
+
+
+class BackgroundWriter:
+    """ thread writing the values set on ``cache`` while tests run, see
+    the ``cache_writer`` ini option.
+
+    Writes are queued per key; a value set again before it was written
+    replaces the queued one.  When more than ``maxpending`` bytes are
+    queued, setting values blocks until the thread caught up.  Store
+    access from other threads is serialized with :py:attr:`lock`.
+    """
+    maxpending = 16 * 1024 * 1024
+    timeout = 10.0
+
+    def __init__(self, cache):
+        import threading
+        self.cache = cache
+        self.lock = threading.RLock()
+        self._cond = threading.Condition()
+        # key -> list of ("set", data) and ("update", func, default)
+        self._pending = {}
+        self._size = 0
+        self._busy = False
+        self._writing = ()
+        self._abandoned = False
+        self._thread = None
+        self._error = None
+
+    def put(self, key, data):
+        self._cond.acquire()
+        try:
+            while self._size > self.maxpending:
+                self._cond.wait()
+            for op in self._pending.get(key, ()):
+                if op[0] == "set":
+                    self._size -= len(op[1])
+            self._pending[key] = [("set", data)]
+            self._size += len(data)
+            self._wakeup()
+        finally:
+            self._cond.release()
+
+    def update(self, key, func, default):
+        self._cond.acquire()
+        try:
+            self._pending.setdefault(key, []).append(
+                ("update", func, default))
+            self._wakeup()
+        finally:
+            self._cond.release()
+
+    def pending(self, key):
+        return key in self._pending or self._busy
+
+    def _wakeup(self):
+        import threading
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify_all()
+
+    def drain(self, timeout=None):
+        """ wait until all queued writes are done, at most ``timeout``
+        seconds; return True if they are.  Errors of the writer thread
+        are raised here. """
+        deadline = timeout is not None and time.time() + timeout
+        self._cond.acquire()
+        try:
+            while self._pending or (self._busy and not self._abandoned):
+                if deadline is False:
+                    self._cond.wait()
+                elif deadline <= time.time():
+                    return False
+                else:
+                    self._cond.wait(deadline - time.time())
+            error, self._error = self._error, None
+        finally:
+            self._cond.release()
+        if error is not None:
+            raise error
+        return True
+
+    def abandon(self):
+        """ drop the queued writes and return the keys of those and of
+        the ones being written, which may not complete before exit.
+        Later calls of :py:meth:`drain` do not wait for the latter
+        again. """
+        self._cond.acquire()
+        try:
+            keys = set(self._pending).union(self._writing)
+            self._pending = {}
+            self._size = 0
+            self._abandoned = True
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        return sorted(keys)
+
+    def _run(self):
+        while 1:
+            self._cond.acquire()
+            try:
+                while not self._pending:
+                    self._cond.wait()
+                pending, self._pending = self._pending, {}
+                self._size = 0
+                self._busy = True
+                self._writing = sorted(pending)
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+            try:
+                self._write(pending)
+            except Exception:
+                self._error = sys.exc_info()[1]
+            self._cond.acquire()
+            try:
+                self._busy = False
+                self._writing = ()
+                self._abandoned = False
+                self._cond.notify_all()
+            finally:
+                self._cond.release()
+
+    def _write(self, pending):
+        cache = self.cache
+        items = [(key, ops[0][1]) for key, ops in sorted(pending.items())
+                 if len(ops) == 1 and ops[0][0] == "set"]
+        cache._writeitems(items)
+        for key, ops in sorted(pending.items()):
+            if len(ops) == 1 and ops[0][0] == "set":
+                continue
+            for op in ops:
+                if op[0] == "set":
+                    cache._writeitems([(key, op[1])])
+                else:
+                    cache._applyupdate(key, op[1], op[2])
+
+
+class _LockedStore:
+    """ proxy serializing all calls to ``store`` with ``lock``. """
+    def __init__(self, store, lock):
+        self._store = store
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._lock.acquire()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._lock.release()
+        return call
+
+
+class RemoteStore:
+    """ value store reading through to and pushing to a cache server.
+
+    Values are read from the ``local`` store first; missing values are
+    fetched from the server at ``url`` and kept locally, so fresh
+    checkouts start with the values of earlier runs elsewhere.  Writes
+    go to the local store and are pushed to the server in batches from
+    background threads, see :py:meth:`wait`.  The server is given up on
+    for the rest of the process after the first error.
+
+    Deleting and clearing only affect the local store, so that pruning
+    to a local size budget leaves the values shared with other
+    machines in place; :py:meth:`deleteremote` deletes from the server.
+    Keys starting with one of the ``cleared`` prefixes are not fetched.
+
+    The protocol consists of two requests, ``POST <url>/get`` and
+    ``POST <url>/put``, whose bodies are sequences of records as
+    written by :py:func:`_packrecords`; see :py:func:`makeserver` for
+    the reference server.
+    """
+    batchsize = 4 * 1024 * 1024
+    timeout = 30.0
+
+    def __init__(self, local, url, trace, poolsize=4, cleared=()):
+        self.local = local
+        self.trace = trace
+        # key prefixes not to be fetched, see Cache.clear()
+        self.cleared = cleared
+        self._pool = _ConnectionPool(url, poolsize, self.timeout)
+        self._fetched = set()
+        self._pushers = []
+        self._broken = False
+
+    def path(self, key):
+        return self.local.path(key)
+
+    def keys(self):
+        return self.local.keys()
+
+    def iterkeys(self, prefix=""):
+        return self.local.iterkeys(prefix)
+
+    def mtime(self, key):
+        return self.local.mtime(key)
+
+    def read(self, key):
+        data = self.local.read(key)
+        if data is None and self._fetch([key]):
+            data = self.local.read(key)
+        return data
+
+    def readfresh(self, key):
+        data = self.local.readfresh(key)
+        if data is None and self._fetch([key]):
+            data = self.local.read(key)
+        return data
+
+    def locate(self, key):
+        location = self.local.locate(key)
+        if location is None and self._fetch([key]):
+            location = self.local.locate(key)
+        return location
+
+    def prefetch(self, keys):
+        import threading
+        keys = [key for key in keys if key not in self._fetched and
+                not self._iscleared(key) and self.local.locate(key) is None]
+        if not keys or self._broken:
+            return
+        self._fetched.update(keys)
+        size = self._pool.size
+        results = []
+        threads = [threading.Thread(target=self._get,
+                                    args=(keys[i::size], results))
+                   for i in range(min(size, len(keys)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._keep(results)
+
+    def _fetch(self, keys):
+        """ fetch values missing locally, return how many were found. """
+        keys = [key for key in keys if key not in self._fetched and
+                not self._iscleared(key)]
+        if not keys or self._broken:
+            return 0
+        self._fetched.update(keys)
+        results = []
+        self._get(keys, results)
+        return self._keep(results)
+
+    def _iscleared(self, key):
+        for prefix in self.cleared:
+            if key.startswith(prefix):
+                return True
+        return False
+
+    def _get(self, keys, results):
+        try:
+            status, data = self._pool.request(
+                "POST", "/get", _packrecords([(key, None) for key in keys]))
+            results.extend(_unpackrecords(data))
+        except (EnvironmentError, ValueError):
+            self._giveup()
+
+    def _keep(self, results):
+        items = [(key, data) for key, data in results if data is not None]
+        for key, data in items:
+            self.trace("cache-remote fetched %s: %d bytes" % (key, len(data)))
+        # written from the calling thread, stores are not thread-safe
+        self.local.writemany(items)
+        return len(items)
+
+    def write(self, key, data):
+        self.local.write(key, data)
+        self._push([(key, data)])
+
+    def writemany(self, items):
+        self.local.writemany(items)
+        self._push(items)
+
+    def commitfile(self, key, tmppath):
+        self.local.commitfile(key, tmppath)
+        self._push([(key, self.local.read(key))])
+
+    def delete(self, key):
+        self.local.delete(key)
+
+    def clear(self, prefix):
+        return self.local.clear(prefix)
+
+    def deleteremote(self, keys):
+        """ delete ``keys`` from the server. """
+        self._push([(key, None) for key in keys])
+
+    def _push(self, items):
+        import threading
+        if self._broken or not items:
+            return
+        batches = [[]]
+        size = 0
+        for key, data in items:
+            if size > self.batchsize:
+                batches.append([])
+                size = 0
+            batches[-1].append((key, data))
+            size += len(data or b"")
+        # pushes are sent one after another to keep writes in order
+        previous = self._pushers and self._pushers[-1] or None
+        thread = threading.Thread(target=self._send,
+                                  args=(batches, previous))
+        thread.daemon = True
+        thread.start()
+        self._pushers.append(thread)
+
+    def _send(self, batches, previous):
+        if previous is not None:
+            previous.join()
+        for batch in batches:
+            try:
+                self._pool.request("POST", "/put", _packrecords(batch))
+            except EnvironmentError:
+                self._giveup()
+                return
+            self.trace("cache-remote pushed %d values" % (len(batch),))
+
+    def _giveup(self):
+        if not self._broken:
+            self._broken = True
+            self.trace("cache-remote %s unavailable, using the local "
+                       "cache only" % (self._pool.url,))
+
+    def wait(self, timeout=None):
+        """ wait up to ``timeout`` seconds, by default :py:attr:`timeout`,
+        for pending pushes; return True if all of them completed. """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        for thread in self._pushers:
+            thread.join(max(0, deadline - time.time()))
+        self._pushers = [t for t in self._pushers if t.is_alive()]
+        return not self._pushers
+
+
+class _ConnectionPool:
+    """ keep-alive HTTP connections to the server at ``url``; up to
+    ``size`` idle connections are kept for reuse. """
+    def __init__(self, url, size, timeout):
+        import threading
+        try:
+            from urlparse import urlsplit
+        except ImportError:
+            from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("unsupported cache_remote %r" % (url,))
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self._https = parts.scheme == "https"
+        self._address = (parts.hostname, parts.port)
+        self._prefix = parts.path.rstrip("/")
+        self._idle = []
+        # guards _idle, requests come from several threads at once
+        self._lock = threading.Lock()
+
+    def request(self, method, path, body):
+        """ return status and body of the response to the request, raise
+        EnvironmentError for failed requests and error responses. """
+        try:
+            import httplib as client
+        except ImportError:
+            import http.client as client
+        self._lock.acquire()
+        try:
+            conn = self._idle and self._idle.pop() or None
+        finally:
+            self._lock.release()
+        # an idle connection may have been closed by the server meanwhile,
+        # retry once with a new one
+        for reused in (conn is not None, False):
+            if not reused:
+                if self._https:
+                    conn = client.HTTPSConnection(*self._address,
+                                                  timeout=self.timeout)
+                else:
+                    conn = client.HTTPConnection(*self._address,
+                                                 timeout=self.timeout)
+            try:
+                conn.request(method, self._prefix + path, body,
+                             {"Content-Type": "application/octet-stream"})
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (EnvironmentError, client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise IOError("request to %s failed: %s" % (
+                        self.url, sys.exc_info()[1]))
+        if response.status >= 400:
+            conn.close()
+            raise IOError("%s%s: HTTP %d" % (self.url, path, response.status))
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+            else:
+                conn.close()
+        finally:
+            self._lock.release()
+        return response.status, data
 
-@pytest.mark.tryfirst
-def pytest_configure(config):
-    config.cache = cache = Cache(config)
-    config.pluginmanager.register(LFPlugin(config), "lfplugin")
 
+_record = struct.Struct("<Hq")
 
-def pytest_report_header(config):
-    if config.option.verbose:
-        relpath = py.path.local().bestrelpath(config.cache._cachedir)
-        return "cachedir: %s" % config.cache._cachedir
 
+def _packrecords(items):
+    """ serialize ``(key, data)`` pairs for the cache server protocol:
+    key length, value length (-1 for None) and the key and value bytes. """
+    parts = []
+    for key, data in items:
+        key = key.encode("utf-8")
+        if data is None:
+            parts.extend([_record.pack(len(key), -1), key])
+        else:
+            parts.extend([_record.pack(len(key), len(data)), key, data])
+    return b"".join(parts)
 
-class Cache:
-    def __init__(self, config):
-        self.config = config
-        self._cachedir = getrootdir(config, ".cache")
-        self.trace = config.trace.root.get("cache")
-        if config.getvalue("clearcache"):
-            self.trace("clearing cachedir")
-            self._cachedir.remove()
-            self._cachedir.mkdir()
 
-    def makedir(self, name):
-        """ return a directory path object with the given name.  If the
-        directory does not yet exist, it will be created.  You can use it
-        to manage files likes e. g. store/retrieve database
-        dumps across test sessions.
+def _unpackrecords(data):
+    """ return the ``(key, data)`` pairs serialized by _packrecords. """
+    items = []
+    pos = 0
+    while pos < len(data):
+        if pos + _record.size > len(data):
+            raise ValueError("truncated record")
+        keylen, vallen = _record.unpack(data[pos:pos + _record.size])
+        pos += _record.size
+        key = data[pos:pos + keylen].decode("utf-8")
+        if not _py3:
+            key = key.encode("utf-8")
+        pos += keylen
+        if vallen < 0:
+            value = None
+        else:
+            value = data[pos:pos + vallen]
+            pos += vallen
+        if pos > len(data):
+            raise ValueError("truncated record")
+        items.append((key, value))
+    return items
 
-        :param name: must be a string not containing a ``/`` separator.
-             Make sure the name contains your plugin or application
-             identifiers to prevent clashes with other cache users.
-        """
-        if name.count("/") != 0:
-            raise ValueError("name is not allowed to contain '/'")
-        p = self._cachedir.join("d/" + name)
-        p.ensure(dir=1)
-        return p
 
-    def _getpath(self, key):
-        if not key.count("/") > 1:
-            raise KeyError("Key must be of format 'dir/.../subname")
-        return self._cachedir.join(key)
+def _copybytes(src, dst, length, chunksize=1024 * 1024):
+    while length > 0:
+        chunk = src.read(min(length, chunksize))
+        if not chunk:
+            raise EOFError("unexpected end of %s" % (src.name,))
+        dst.write(chunk)
+        length -= len(chunk)
 
-    def _getvaluepath(self, key):
-        p = self._getpath("v/" + key)
-        p.dirpath().ensure(dir=1)
-        return p
 
-    def get(self, key, default):
-        """ return cached value for the given key.  If no value
-        was yet cached or the value cannot be read, the specified
-        default is returned.
+class XdistCachePlugin:
+    """ Plugin giving pytest-xdist slaves access to the cache.
 
-        :param key: must be a ``/`` separated value. Usually the first
-             name is the name of your plugin or your application.
-        :param default: must be provided in case of a cache-miss or
-             invalid cache values.
+    The master sends the values read by the bundled plugins to each
+    slave once when it starts, within ``snapshot_maxtotal`` bytes, and
+    flushes its own values so that slaves read all others from disk on
+    first use.  Slaves hand the values they set back when they finish;
+    the master then writes them along with its own values, so slaves
+    only write to the cache directory to share :py:meth:`Cache.memoize`
+    results right away.  When several slaves set the same key, the last
+    slave to finish wins.
+    """
+    snapshot_keys = _pluginkeys
+    snapshot_maxsize = 1024 * 1024
+    snapshot_maxtotal = 4 * 1024 * 1024
 
-        """
-        from execnet import loads, DataFormatError
-        path = self._getvaluepath(key)
-        if path.check():
-            f = path.open("rb")
-            try:
-                try:
-                    return loads(f.read())
-                finally:
-                    f.close()
-            except DataFormatError:
-                self.trace("cache-invalid at %s" % (key,))
-        return default
+    def __init__(self, config):
+        self.config = config
+        self._snapshot = None
 
-    def set(self, key, value):
-        """ save value for the given key.
+    def pytest_configure_node(self, node):
+        if self._snapshot is None:
+            self._snapshot = self.config.cache._getsnapshot(
+                self.snapshot_keys, self.snapshot_maxsize,
+                self.snapshot_maxtotal)
+        node.slaveinput["cache_snapshot"] = self._snapshot
 
-        :param key: must be a ``/`` separated value. Usually the first
-             name is the name of your plugin or your application.
-        :param value: must be of any combination of basic
-               python types, including nested types
-               like e. g. lists of dictionaries.
-        """
-        from execnet import dumps, DataFormatError
-        path = self._getvaluepath(key)
-        f = path.open("wb")
-        try:
-            try:
-                self.trace("cache-write %s: %r" % (key, value,))
-                return f.write(dumps(value))
-            finally:
-                f.close()
-        except DataFormatError:
-            raise ValueError("cannot serialize a builtin python type")
+    def pytest_testnodedown(self, node, error):
+        slaveoutput = getattr(node, "slaveoutput", {})
+        self.config.cache._mergeslave(slaveoutput)
 
 
 class LFPlugin:
-    """ Plugin which implements the --lf (run last-failing) option """
+    """ Plugin which implements the --lf (run last-failing) and --ff
+    (run last-failing first) options """
     def __init__(self, config):
         self.config = config
-        if config.getvalue("lf"):
+        self.journal = None
+        if not hasattr(config, "slaveinput"):
+            self.journal = OutcomeJournal(config.cache)
+        if config.getvalue("lf") or config.getvalue("failedfirst"):
+            if self.journal is not None:
+                self.journal.recover()
             self.lastfailed = config.cache.get("cache/lastfailed", set())
         else:
             self.lastfailed = set()
+        # outcomes of this session, merged into the stored set at the end
+        self.failed = set()
+        self.passed = set()
+        # files collected in full and the node ids of their items, to
+        # forget failures of tests which no longer exist
+        self.collectedfiles = set()
+        self.collected = set()
+        self._lfpaths = None
 
     def pytest_report_header(self):
         if self.config.getvalue("lf"):
@@ -129,19 +2627,85 @@ class LFPlugin:
             else:
                 mode = "rerun last %d failures" % len(self.lastfailed)
             return "run-last-failure: %s" % mode
+        elif self.config.getvalue("failedfirst") and self.lastfailed:
+            return "run-last-failure: run last %d failures first" % (
+                len(self.lastfailed),)
 
     def pytest_runtest_logreport(self, report):
         if report.failed and "xfail" not in report.keywords:
             self.lastfailed.add(report.nodeid)
+            self.failed.add(report.nodeid)
+            self.passed.discard(report.nodeid)
+            if self.journal is not None:
+                self.journal.record("F", report.nodeid)
         elif not report.failed:
             if report.when == "call":
-                try:
-                    self.lastfailed.remove(report.nodeid)
-                except KeyError:
-                    pass
+                self.lastfailed.discard(report.nodeid)
+                if report.nodeid not in self.failed:
+                    self.passed.add(report.nodeid)
+                    if self.journal is not None:
+                        self.journal.record("P", report.nodeid)
+
+    def pytest_collectreport(self, report):
+        if not report.passed:
+            return
+        if report.nodeid and "::" not in report.nodeid:
+            self.collectedfiles.add(report.nodeid)
+        for node in report.result:
+            if isinstance(node, pytest.Item):
+                self.collected.add(node.nodeid)
+
+    def pytest_ignore_collect(self, path, config):
+        """ with --lf, skip collecting files without recorded failures. """
+        if self._lfpaths is None:
+            self._lfpaths = self._getlfpaths()
+        if not self._lfpaths:
+            return None
+        if path.check(dir=1):
+            for lfpath in self._lfpaths:
+                if lfpath.relto(path):
+                    return None
+            return True
+        elif path not in self._lfpaths:
+            return True
+
+    def _getlfpaths(self):
+        """ return the files of recorded failures below the command line
+        arguments, or an empty set if collection must not be pruned. """
+        if not self.config.getvalue("lf") or not self.lastfailed:
+            return set()
+        # node ids are relative to the directory pytest was started in
+        invocationdir = py.path.local()
+        args = [invocationdir.join(str(arg).split("::")[0])
+                for arg in self.config.args]
+        lfpaths = set()
+        for nodeid in self.lastfailed:
+            lfpath = invocationdir.join(_splitnodeid(nodeid)[0])
+            for arg in args:
+                if lfpath == arg or lfpath.relto(arg):
+                    lfpaths.add(lfpath)
+                    break
+        for lfpath in lfpaths:
+            if not lfpath.check(file=1):
+                # a failing test's file is gone, let --lf decide on the
+                # fully collected items
+                return set()
+        return lfpaths
 
     def pytest_collection_modifyitems(self, session, config, items):
         if self.config.getvalue("lf") and self.lastfailed:
+            if not [x for x in items if x.nodeid in self.lastfailed]:
+                # the recorded failures are gone: run everything that
+                # was collected, which is only the files of the failures
+                # if collection was pruned to them
+                if self._lfpaths:
+                    terminal = config.pluginmanager.getplugin(
+                        "terminalreporter")
+                    if terminal is not None:
+                        terminal.write_line(
+                            "run-last-failure: recorded failures not "
+                            "found, running all tests of their files")
+                return
             newitems = []
             deselected = []
             for item in items:
@@ -151,29 +2715,866 @@ class LFPlugin:
                     deselected.append(item)
             items[:] = newitems
             config.hook.pytest_deselected(items=deselected)
+        elif self.config.getvalue("failedfirst") and self.lastfailed:
+            failed = []
+            other = []
+            for item in items:
+                if item.nodeid in self.lastfailed:
+                    failed.append(item)
+                else:
+                    other.append(item)
+            items[:] = failed + other
 
     def pytest_sessionfinish(self, session):
         config = self.config
         if config.getvalue("showcache") or hasattr(config, "slaveinput"):
             return
-        config.cache.set("cache/lastfailed", self.lastfailed)
+        # merge instead of overwriting so that sessions running
+        # concurrently, e. g. from several tox envs, keep each other's
+        # results
+        self.journal.recover()
+        failed, passed = self.failed, self.passed
+        files, collected = self._fullycollected(), self.collected
+
+        def merge(old):
+            gone = set([nodeid for nodeid in old
+                        if _splitnodeid(nodeid)[0] in files and
+                        nodeid not in collected])
+            return (old - passed - gone) | failed
+        config.cache._updatelater("cache/lastfailed", merge, set())
+
+    def _fullycollected(self):
+        """ return the node ids of the files collected in this session
+        which were not narrowed to some of their tests by ``file::name``
+        arguments. """
+        invocationdir = py.path.local()
+        narrowed = set()
+        for arg in self.config.args:
+            if "::" in str(arg):
+                path = invocationdir.join(str(arg).split("::")[0])
+                narrowed.add(path.relto(invocationdir).replace(os.sep, "/"))
+        return self.collectedfiles - narrowed
+
+    def pytest_unconfigure(self, config):
+        if self.journal is not None:
+            # the journal is only obsolete once the merge is on disk,
+            # otherwise the next session replays it
+            dropped = _finalflush(config)
+            self.journal.close(keep=bool(dropped))
+
+
+class OutcomeJournal:
+    """ append-only record of the failures and passes of one session.
+
+    Each outcome is written to the journal, a file below
+    ``.cache/journal`` locked by the session, as soon as it is reported,
+    so that a session killed before merging its outcomes into
+    ``cache/lastfailed`` loses none of them: the next session replays
+    all journals which are no longer locked and then removes them.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self._lock = None
+        self._recovered = False
+
+    def record(self, outcome, nodeid):
+        if self._lock is None:
+            self.recover()
+            directory = self.cache._envdir.join("journal")
+            directory.ensure(dir=1)
+            fd, name = tempfile.mkstemp(prefix="lastfailed-",
+                                        dir=str(directory))
+            os.close(fd)
+            self._lock = FileLock(py.path.local(name))
+            self._lock.acquire()
+        f = self._lock._file
+        f.write(("%s %s\n" % (outcome, nodeid)).encode("utf-8"))
+        f.flush()
+
+    def close(self, keep=False):
+        """ release the journal and remove it unless ``keep`` is true. """
+        if self._lock is not None:
+            if not keep:
+                self._lock.path.remove()
+            self._lock.release()
+            self._lock = None
+
+    def recover(self):
+        """ replay the journals of dead sessions into ``cache/lastfailed``
+        and remove them, once per session.  This happens on first use of
+        the journal or of recorded failures, so runs which do neither
+        never resolve the cache directory. """
+        if not self._recovered:
+            self._recovered = True
+            self._release(True)
+
+    def discard(self):
+        """ remove the journals of dead sessions without replaying them. """
+        self._release(False)
+
+    def _release(self, recover):
+        directory = self.cache._envdir.join("journal")
+        if not directory.check(dir=1):
+            return
+        for path in directory.listdir("lastfailed-*"):
+            lock = FileLock(path)
+            if not lock.acquire(blocking=False):
+                continue  # the session is still running
+            try:
+                if not recover:
+                    path.remove()
+                    continue
+                outcomes = _readjournal(path)
+                self.cache.trace("cache-journal replaying %d outcomes of %s"
+                                 % (len(outcomes), path.basename))
+
+                def replay(lastfailed):
+                    for outcome, nodeid in outcomes:
+                        if outcome == "F":
+                            lastfailed.add(nodeid)
+                        else:
+                            lastfailed.discard(nodeid)
+                    return lastfailed
+                self.cache.update("cache/lastfailed", replay, set())
+                path.remove()
+            finally:
+                lock.release()
+
+
+def _readjournal(path):
+    """ return the ``(outcome, nodeid)`` pairs of a journal, skipping
+    a last line cut short by a crash. """
+    outcomes = []
+    for line in path.read("rb").split(b"\n")[:-1]:
+        outcome, _, nodeid = line.decode("utf-8", "replace").partition(" ")
+        if outcome in ("F", "P") and nodeid:
+            if not _py3:
+                nodeid = nodeid.encode("utf-8")
+            outcomes.append((outcome, nodeid))
+    return outcomes
+
+
+class NFPlugin:
+    """ Plugin which implements the --nf (run new files first) option.
+
+    It records the modification time of each collected test file in
+    ``cache/mtimes`` so that the next --nf run can tell which files
+    are new or were modified since.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.mtimes = {}
+
+    @pytest.mark.tryfirst
+    def pytest_collection_modifyitems(self, session, config, items):
+        # runs before LFPlugin's hook so that --ff puts the last
+        # failures in front of the new files
+        mtimes = self.mtimes
+        for item in items:
+            path = str(item.fspath)
+            if path not in mtimes:
+                try:
+                    mtimes[path] = item.fspath.mtime()
+                except EnvironmentError:
+                    mtimes[path] = None
+        if config.getvalue("newfirst"):
+            lastmtimes = config.cache.get("cache/mtimes", {})
+            new = []
+            other = []
+            for item in items:
+                path = str(item.fspath)
+                if lastmtimes.get(path) != mtimes[path]:
+                    new.append(item)
+                else:
+                    other.append(item)
+            items[:] = new + other
+
+    def pytest_sessionfinish(self, session):
+        config = self.config
+        if config.getvalue("showcache") or not self.mtimes:
+            return
+        mtimes = self.mtimes
+
+        def merge(old):
+            old.update(mtimes)
+            return old
+        config.cache._updatelater("cache/mtimes", merge, {})
+
+
+class DurationsPlugin:
+    """ Plugin recording a rolling history of test durations in
+    ``cache/durations`` and implementing the --durations-order option """
+    def __init__(self, config):
+        self.config = config
+        self.durations = {}
+
+    def pytest_runtest_logreport(self, report):
+        duration = getattr(report, "duration", None)
+        if duration is not None:
+            nodeid = report.nodeid
+            self.durations[nodeid] = self.durations.get(nodeid, 0) + duration
+
+    @pytest.mark.tryfirst
+    def pytest_collection_modifyitems(self, session, config, items):
+        if config.getvalue("durationsorder"):
+            history = DurationHistory(config.cache.get("cache/durations", {}))
+            means = history.means()
+            inf = float("inf")
+            items.sort(key=lambda item: -means.get(item.nodeid, inf))
+
+    def pytest_sessionfinish(self, session):
+        config = self.config
+        if (config.getvalue("showcache") or hasattr(config, "slaveinput")
+                or not self.durations):
+            return
+        durations = self.durations
+
+        def merge(old):
+            history = DurationHistory(old)
+            history.add(durations)
+            return history.data
+        config.cache._updatelater("cache/durations", merge, {})
+
+
+class DurationHistory:
+    """ the last ``size`` durations of each test, stored as a dict
+    mapping each test file to a list of test names and a packed array
+    of ``size`` float32 seconds per name, oldest first and padded with
+    NaNs. """
+    size = 8
+
+    def __init__(self, data):
+        self.data = data
+
+    def add(self, durations):
+        """ record the ``durations`` dict of nodeids and seconds. """
+        byfile = {}
+        for nodeid, duration in durations.items():
+            filename, name = _splitnodeid(nodeid)
+            byfile.setdefault(filename, []).append((name, duration))
+        size = self.size
+        for filename, entries in byfile.items():
+            names, values = self._unpack(filename)
+            positions = dict((name, i) for i, name in enumerate(names))
+            for name, duration in entries:
+                i = positions.get(name)
+                if i is None:
+                    positions[name] = len(names)
+                    names.append(name)
+                    values.extend([float("nan")] * (size - 1) + [duration])
+                else:
+                    start = i * size
+                    values[start:start + size] = (
+                        values[start + 1:start + size] +
+                        array.array("f", [duration]))
+            self.data[filename] = [names, _packfloats(values)]
+
+    def _unpack(self, filename):
+        names, packed = self.data.get(filename, ([], b""))
+        return list(names), _unpackfloats(packed)
+
+    def means(self):
+        """ return a dict mapping nodeids to their mean duration. """
+        size = self.size
+        means = {}
+        for filename in self.data:
+            names, values = self._unpack(filename)
+            for i, name in enumerate(names):
+                recorded = [x for x in values[i * size:(i + 1) * size]
+                            if x == x]  # not NaN
+                if recorded:
+                    nodeid = name and "%s::%s" % (filename, name) or filename
+                    means[nodeid] = sum(recorded) / len(recorded)
+        return means
+
+    def slowest(self, n):
+        """ return the ``n`` (mean duration, nodeid) pairs with the longest
+        mean durations. """
+        means = [(duration, nodeid)
+                 for nodeid, duration in self.means().items()]
+        means.sort(reverse=True)
+        return means[:n]
+
+
+def _splitnodeid(nodeid):
+    parts = nodeid.split("::", 1)
+    if len(parts) == 1:
+        return parts[0], ""
+    return parts
+
+
+def _packfloats(values):
+    values = array.array("f", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    if _py3:
+        return values.tobytes()
+    return values.tostring()
+
+
+def _unpackfloats(data):
+    values = array.array("f")
+    if _py3:
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class FlakyPlugin:
+    """ Plugin recording the outcomes of the recent runs of each test in
+    ``cache/outcomes`` and implementing the --rerun-flaky and
+    --flaky-report options """
+    def __init__(self, config):
+        self.config = config
+        self.reruns = config.getvalue("rerunflaky")
+        self.history = None
+        if self.reruns or config.getvalue("flakyreport"):
+            self.history = OutcomeHistory(
+                config.cache.get("cache/outcomes", {}))
+        if self.reruns:
+            flaky = set([nodeid for flips, rate, nodeid
+                         in self.history.flaky()])
+            # a separate plugin as the hook needs pytest-2.3's nextitem
+            config.pluginmanager.register(
+                FlakyRerunPlugin(flaky, self.reruns), "flakyrerunplugin")
+        # outcomes of this session, a list of failed flags per nodeid
+        self.outcomes = {}
+        self.rerun = {}
+        self._running = {}
+
+    def pytest_runtest_logreport(self, report):
+        nodeid = report.nodeid
+        reruns = getattr(report, "flakyreruns", 0)
+        if reruns:
+            self.rerun[nodeid] = reruns
+            self.outcomes.setdefault(nodeid, []).extend([True] * reruns)
+        failed, ran = self._running.pop(nodeid, (False, False))
+        failed = failed or _isfailure(report)
+        ran = ran or report.when == "call"
+        if report.when != "teardown":
+            self._running[nodeid] = failed, ran
+        elif failed or ran:  # skipped tests are not recorded
+            self.outcomes.setdefault(nodeid, []).append(failed)
+
+    def pytest_sessionfinish(self, session):
+        config = self.config
+        if (config.getvalue("showcache") or hasattr(config, "slaveinput")
+                or not self.outcomes):
+            return
+        outcomes = self.outcomes
+
+        def merge(old):
+            history = OutcomeHistory(old)
+            history.add(outcomes)
+            return history.data
+        config.cache._updatelater("cache/outcomes", merge, {})
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.rerun:
+            terminalreporter.write_sep("-", "rerun flaky tests")
+            for nodeid in sorted(self.rerun):
+                terminalreporter.write_line("%s: %d reruns" % (
+                    nodeid, self.rerun[nodeid]))
+        if self.history is not None and self.config.getvalue("flakyreport"):
+            history = OutcomeHistory(dict(self.history.data))
+            history.add(self.outcomes)
+            _flakyreport(terminalreporter.write_sep,
+                         terminalreporter.write_line, history)
+
+
+class FlakyRerunPlugin:
+    """ Plugin rerunning failing tests of ``flaky`` up to ``reruns``
+    times, only the reports of the last run are logged """
+    def __init__(self, flaky, reruns):
+        self.flaky = flaky
+        self.reruns = reruns
+
+    @pytest.mark.tryfirst
+    def pytest_runtest_protocol(self, item, nextitem):
+        if item.nodeid not in self.flaky:
+            return None
+        from _pytest.runner import runtestprotocol
+        item.ihook.pytest_runtest_logstart(nodeid=item.nodeid,
+                                           location=item.location)
+        reruns = 0
+        while True:
+            reports = runtestprotocol(item, nextitem=nextitem, log=False)
+            if reruns == self.reruns or not [
+                    r for r in reports if _isfailure(r)]:
+                break
+            reruns += 1
+        # the failed attempts are only recorded in the outcome history,
+        # also when the reports are sent from an xdist slave
+        reports[0].flakyreruns = reruns
+        for report in reports:
+            item.ihook.pytest_runtest_logreport(report=report)
+        return True
+
+
+def _isfailure(report):
+    return report.failed and "xfail" not in report.keywords
+
+
+def _flakyreport(sep, line, history):
+    sep("-", "flaky tests (failure rate over the last %d runs)" % (
+        OutcomeHistory.size,))
+    flaky = history.flaky()
+    for flips, rate, nodeid in flaky:
+        line("%5.1f%% %3d flips  %s" % (rate * 100, flips, nodeid))
+    if not flaky:
+        line("no flaky tests")
+
+
+class OutcomeHistory:
+    """ the outcomes of the last ``size`` runs of each test, stored as a
+    dict mapping nodeids to ints: bit ``i`` is set if the test failed
+    ``i`` runs ago and the highest bit, above those of the recorded
+    runs, marks their number. """
+    size = 20
+
+    def __init__(self, data):
+        self.data = data
+
+    def add(self, outcomes):
+        """ record the ``outcomes`` dict mapping nodeids to lists of
+        failed flags, oldest first. """
+        for nodeid, flags in outcomes.items():
+            value = self.data.get(nodeid, 1)
+            for failed in flags:
+                runs = min(value.bit_length(), self.size)
+                bits = ((value << 1) | bool(failed)) & ((1 << runs) - 1)
+                value = (1 << runs) | bits
+            self.data[nodeid] = value
+
+    def failures(self, nodeid):
+        """ return the failed flags of the recorded runs, oldest first. """
+        value = self.data.get(nodeid, 1)
+        return [bool(value >> i & 1)
+                for i in range(value.bit_length() - 2, -1, -1)]
+
+    def flaky(self):
+        """ return (flips, failure rate, nodeid) tuples for the tests
+        whose outcome changed at least twice, most flips first.  A test
+        which broke once and was fixed changes only once. """
+        result = []
+        for nodeid in self.data:
+            failed = self.failures(nodeid)
+            flips = len([1 for before, after in zip(failed, failed[1:])
+                         if before != after])
+            if flips >= 2:
+                rate = failed.count(True) / float(len(failed))
+                result.append((flips, rate, nodeid))
+        result.sort(key=lambda x: (-x[0], -x[1], x[2]))
+        return result
+
+
+class CollectIndexPlugin:
+    """ Plugin which implements the --collect-cache option.
+
+    It records the node ids and keywords of the tests collected from
+    each test file in ``cache/collection``, together with a digest of
+    the file and of the conftest.py files above it.  When tests are
+    selected with -k or -m, files whose digest is unchanged and whose
+    recorded tests are all deselected are not collected at all.  Each
+    collected file replaces its own entry, so changes invalidate the
+    index one file at a time.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.keywordexpr = config.getvalue("keyword")
+        self.markexpr = getattr(config.option, "markexpr", "")
+        self.skipped = 0
+        self._index = None
+        self._seen = {}
+        self._errors = set()
+        self._chaindigests = {}
+
+    def _getindex(self):
+        if self._index is None:
+            self._index = self.config.cache.get("cache/collection", {})
+        return self._index
+
+    def pytest_ignore_collect(self, path, config):
+        if not (self.keywordexpr or self.markexpr) or path.check(dir=1):
+            return None
+        entry = self._getindex().get(str(path))
+        if entry is None or not self._isfresh(path, entry):
+            return None
+        for nodeid, keywords, names in entry[4]:
+            if _isselected(keywords, names, self.keywordexpr,
+                           self.markexpr) is not False:
+                return None
+        self.skipped += 1
+        return True
+
+    def pytest_collect_file(self, path, parent):
+        if _istestfile(path, self.config):
+            self._seen.setdefault(str(path), [])
+
+    def pytest_collectreport(self, report):
+        if report.failed:
+            filename = _splitnodeid(report.nodeid)[0]
+            self._errors.add(str(py.path.local().join(filename)))
+
+    @pytest.mark.tryfirst
+    def pytest_collection_modifyitems(self, session, config, items):
+        # runs before -k and -m deselect items
+        for item in items:
+            self._seen.setdefault(str(item.fspath), []).append(
+                [item.nodeid, sorted(item.keywords), _keywordnames(item)])
+
+    def pytest_sessionfinish(self, session):
+        if not self._seen or hasattr(self.config, "slaveinput"):
+            return
+        entries = {}
+        for filename, items in self._seen.items():
+            if filename not in self._errors:
+                path = py.path.local(filename)
+                try:
+                    stat = path.stat()
+                except EnvironmentError:
+                    continue
+                entries[filename] = [stat.mtime, stat.size,
+                                     _filedigest(path),
+                                     self._chaindigest(path.dirpath()),
+                                     items]
+
+        def merge(index):
+            for filename in list(index):
+                if filename not in entries and not os.path.exists(filename):
+                    del index[filename]
+            index.update(entries)
+            return index
+        self.config.cache._updatelater("cache/collection", merge, {})
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.skipped:
+            terminalreporter.write_line(
+                "collect-cache: skipped %d unchanged files without "
+                "selected tests" % (self.skipped,))
+
+    def _isfresh(self, path, entry):
+        mtime, size, digest, chaindigest = entry[:4]
+        if self._chaindigest(path.dirpath()) != chaindigest:
+            return False
+        try:
+            stat = path.stat()
+        except EnvironmentError:
+            return False
+        if stat.mtime == mtime and stat.size == size:
+            return True
+        return _filedigest(path) == digest
+
+    def _chaindigest(self, dirpath):
+        """ return a digest of all conftest.py files from ``dirpath`` up
+        to the root directory. """
+        key = str(dirpath)
+        try:
+            return self._chaindigests[key]
+        except KeyError:
+            pass
+        rootdir = self.config.cache._cachedir.dirpath()
+        if dirpath == rootdir or not dirpath.relto(rootdir):
+            parent = ""
+        else:
+            parent = self._chaindigest(dirpath.dirpath())
+        conftest = dirpath.join("conftest.py")
+        if conftest.check(file=1):
+            digest = hashlib.sha1((parent + _filedigest(conftest)).encode(
+                "ascii")).hexdigest()
+        else:
+            digest = parent
+        self._chaindigests[key] = digest
+        return digest
+
+
+def _filedigest(path):
+    return hashlib.sha1(path.read("rb")).hexdigest()
+
+
+def _istestfile(path, config):
+    import fnmatch
+    if path.ext != ".py":
+        return False
+    try:
+        patterns = config.getini("python_files")
+    except ValueError:
+        patterns = ["test_*.py", "*_test.py"]
+    for pattern in patterns:
+        if fnmatch.fnmatch(path.basename, pattern):
+            return True
+    return False
+
+
+def _keywordnames(item):
+    """ return the names -k matches against for ``item``, as collected by
+    pytest's mark plugin. """
+    names = set(item.keywords)
+    for node in item.listchain():
+        if type(node).__name__ != "Instance":
+            names.add(node.name)
+    function = getattr(item, "function", None)
+    names.update(getattr(function, "__dict__", ()))
+    return sorted(names)
+
+
+class _NameMapping(object):
+    def __init__(self, match):
+        self._match = match
+
+    def __getitem__(self, name):
+        return self._match(name)
+
+
+def _isselected(keywords, names, keywordexpr, markexpr):
+    """ return whether a test with the recorded ``keywords`` and
+    ``names`` is selected by the -k and -m expressions, or None if
+    that cannot be told without collecting it. """
+    if keywordexpr and (keywordexpr.startswith("-") or
+                        keywordexpr.endswith(":")):
+        return None  # old-style -k syntax
+    keywords = set(keywords)
+    try:
+        if markexpr and not eval(markexpr, {}, _NameMapping(
+                lambda name: name in keywords)):
+            return False
+        if keywordexpr and not eval(keywordexpr, {}, _NameMapping(
+                lambda sub: any(sub in name for name in names))):
+            return False
+    except Exception:
+        return None
+    return True
+
+
+class ImpactPlugin:
+    """ Plugin which implements the --record-impact and --changed options.
+
+    While a test runs, a global trace function (which does not trace
+    individual lines) notes the file of every called python function.
+    The files below the root directory are attached to the teardown
+    report, so that the master of a distributed run sees them too, and
+    merged into the ``cache/impact`` index at the end of the session.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.touched = {}
+        self._files = None
+        self._relpaths = {}
+        self._excluded = [os.path.abspath(x) + os.sep for x in
+                          set([sys.prefix, sys.exec_prefix])]
+
+    @pytest.mark.tryfirst
+    def pytest_runtest_setup(self, item):
+        if self._files is None:
+            if sys.gettrace() is not None:
+                self.config.trace.get("warn")(
+                    "another trace function is active, not recording "
+                    "the impact of %s" % (item.nodeid,))
+                return
+            self._files = set()
+            sys.settrace(self._trace)
+
+    def _trace(self, frame, event, arg):
+        self._files.add(frame.f_code.co_filename)
+
+    @pytest.mark.tryfirst
+    def pytest_runtest_logreport(self, report):
+        if report.when == "teardown" and self._files is not None:
+            sys.settrace(None)
+            files = [self._relpath(x) for x in self._files]
+            report.touchedfiles = sorted([x for x in files if x])
+            self._files = None
+        touched = getattr(report, "touchedfiles", None)
+        if touched is not None and not hasattr(self.config, "slaveinput"):
+            self.touched[report.nodeid] = touched
+
+    def _relpath(self, filename):
+        try:
+            return self._relpaths[filename]
+        except KeyError:
+            pass
+        relpath = None
+        path = os.path.abspath(filename)
+        if (os.path.isfile(path) and
+                not [x for x in self._excluded if path.startswith(x)] and
+                os.path.splitext(path)[0] !=
+                os.path.splitext(os.path.abspath(__file__))[0]):
+            rootdir = self.config.cache._cachedir.dirpath()
+            relpath = py.path.local(path).relto(rootdir)
+            relpath = relpath and relpath.replace(os.sep, "/") or None
+        self._relpaths[filename] = relpath
+        return relpath
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        if not config.getvalue("changed"):
+            return
+        index = ImpactIndex(config.cache.get("cache/impact", {}))
+        if not index.data["nodeids"]:
+            return  # nothing recorded yet, run everything
+        rootdir = config.cache._cachedir.dirpath()
+        selected = index.affected(rootdir)
+        selected.update(config.cache.get("cache/lastfailed", set()))
+        known = set(index.data["nodeids"])
+        newitems = []
+        deselected = []
+        for item in items:
+            if item.nodeid in selected or item.nodeid not in known:
+                newitems.append(item)
+            else:
+                deselected.append(item)
+        items[:] = newitems
+        config.hook.pytest_deselected(items=deselected)
+
+    def pytest_sessionfinish(self, session):
+        if not self.touched or hasattr(self.config, "slaveinput"):
+            return
+        touched = self.touched
+        rootdir = self.config.cache._cachedir.dirpath()
+
+        def merge(data):
+            index = ImpactIndex(data)
+            index.record(touched, rootdir)
+            return index.data
+        self.config.cache._updatelater("cache/impact", merge, {})
+
+
+class ImpactIndex:
+    """ inverted index of the source files each test executed code from,
+    as stored in ``cache/impact``: a list of node ids and a dict mapping
+    file paths relative to the root directory to a list of
+    ``[mtime, size, sha1, indices]`` entries, one per file version the
+    tests with the node ids at ``indices`` were last recorded with.
+    Tests not rerun since a file changed keep the old version's entry,
+    so they still count as affected by the change. """
+    def __init__(self, data):
+        data.setdefault("nodeids", [])
+        data.setdefault("files", {})
+        self.data = data
+
+    def record(self, touched, rootdir):
+        """ replace the entries of the tests in ``touched``, a dict
+        mapping node ids to the relative paths of their files. """
+        nodeids = self.data["nodeids"]
+        # (filename, signature) pairs per node id
+        forward = dict((nodeid, {}) for nodeid in nodeids)
+        for filename, entries in self.data["files"].items():
+            for mtime, size, digest, indices in entries:
+                for i in indices:
+                    forward[nodeids[i]][filename] = (mtime, size, digest)
+        signatures = {}
+        for filenames in touched.values():
+            for filename in filenames:
+                if filename in signatures:
+                    continue
+                path = rootdir.join(filename)
+                try:
+                    stat = path.stat()
+                except EnvironmentError:
+                    continue
+                signatures[filename] = (stat.mtime, stat.size,
+                                        _filedigest(path))
+        for nodeid, filenames in touched.items():
+            forward[nodeid] = dict((filename, signatures[filename])
+                                   for filename in filenames
+                                   if filename in signatures)
+        nodeids = sorted(forward)
+        groups = {}
+        for i, nodeid in enumerate(nodeids):
+            for filename, signature in forward[nodeid].items():
+                groups.setdefault((filename, signature), []).append(i)
+        files = {}
+        for (filename, signature), indices in sorted(groups.items()):
+            files.setdefault(filename, []).append(list(signature) +
+                                                  [indices])
+        self.data["nodeids"] = nodeids
+        self.data["files"] = files
+
+    def _changedentries(self, rootdir):
+        """ return the entries of files which changed or disappeared
+        since they were recorded. """
+        changed = []
+        for filename, entries in self.data["files"].items():
+            path = rootdir.join(filename)
+            try:
+                stat = path.stat()
+            except EnvironmentError:
+                changed.extend(entries)
+                continue
+            digest = None
+            for entry in entries:
+                if (stat.mtime, stat.size) == (entry[0], entry[1]):
+                    continue
+                if digest is None:
+                    digest = _filedigest(path)
+                if digest != entry[2]:
+                    changed.append(entry)
+        return changed
+
+    def affected(self, rootdir):
+        """ return the node ids of tests which executed code from files
+        which changed since the tests were recorded. """
+        nodeids = self.data["nodeids"]
+        affected = set()
+        for entry in self._changedentries(rootdir):
+            for i in entry[3]:
+                affected.add(nodeids[i])
+        return affected
+
+
+def prunecache(config, session):
+    tw = py.io.TerminalWriter()
+    tw.line("cachedir: " + str(config.cache._cachedir))
+    tw.line("namespace: " + config.cache.namespace)
+    maxsize = _parsesize(config.getini("cache_maxsize"))
+    removed = config.cache.prune(maxsize)
+    for kind, name, size in removed:
+        kind = {"values": "value", "dirs": "directory", "blobs": "blob"}[kind]
+        tw.line("removed %s %s (%d bytes)" % (kind, name, size))
+    tw.line("pruned %d cache entries, %d bytes" % (
+            len(removed), sum([size for kind, name, size in removed])))
+    return 0
 
 
 def showcache(config, session):
     from pprint import pprint
+    cache = config.cache
     tw = py.io.TerminalWriter()
-    tw.line("cachedir: " + str(config.cache._cachedir))
-    if not config.cache._cachedir.check():
-        tw.line("cache is empty")
+    asjson = config.getvalue("cachejson")
+    withvalues = config.getvalue("cachevalues")
+    pattern = config.getvalue("cachefilter") or ""
+    if not asjson:
+        tw.line("cachedir: " + str(cache._cachedir))
+        tw.line("namespace: " + cache.namespace)
+    if not cache._envdir.check():
+        if not asjson:
+            tw.line("cache is empty")
         return 0
     dummy = object()
-    basedir = config.cache._cachedir
-    vdir = basedir.join("v")
-    tw.sep("-", "cache values")
-    for valpath in vdir.visit(lambda x: x.check(file=1)):
-        key = valpath.relto(vdir)
-        val = config.cache.get(key, dummy)
-        if val is dummy:
+    basedir = cache._envdir
+    if not asjson:
+        tw.sep("-", "cache values")
+    # keys are listed and shown one by one so that the output starts
+    # right away and only matching keys are read
+    for key in cache._store.iterkeys(_globprefix(pattern)):
+        if not _keymatches(key, pattern):
+            continue
+        info = _valueinfo(cache._store, key)
+        if info is None:
+            continue
+        if withvalues:
+            val = cache.get(key, dummy)
+        if asjson:
+            if withvalues and val is not dummy:
+                info["value"] = JSONCodec._tojson(val)
+            tw.line(_jsonline(info))
+        elif not withvalues:
+            tw.line("%s: %d bytes, %s, %s" % (
+                key, info["size"], info["codec"],
+                _formattime(info["mtime"])))
+        elif val is dummy:
             tw.line("%s contains unreadable content, "
                   "will be ignored" % key)
         else:
@@ -184,19 +3585,116 @@ def showcache(config, session):
                 tw.line("  " + line)
 
     ddir = basedir.join("d")
-    if ddir.check(dir=1) and ddir.listdir():
+    names = ddir.check(dir=1) and sorted(os.listdir(str(ddir))) or []
+    names = [name for name in names if _keymatches(name, pattern)]
+    if names and not asjson:
         tw.sep("-", "cache directories")
-        for p in basedir.join("d").visit():
-            #if p.check(dir=1):
-            #    print("%s/" % p.relto(basedir))
-            if p.check(file=1):
-                key = p.relto(basedir)
-                tw.line("%s is a file of length %d" % (
-                        key, p.size()))
+    dirsizes = cache._getmeta()["dirs"]
+    for name in names:
+        # sizes come from the metadata index, walking directories is
+        # left to --cache-values
+        size = (dirsizes.get(name) or [None])[0]
+        if asjson:
+            info = {"dir": name, "size": size}
+            if withvalues:
+                info["files"] = dict(
+                    (p.relto(ddir).replace(os.sep, "/"), p.size())
+                    for p in ddir.join(name).visit(lambda p: p.check(file=1)))
+            tw.line(_jsonline(info))
+        elif withvalues:
+            for p in ddir.join(name).visit():
+                if p.check(file=1):
+                    key = p.relto(basedir)
+                    tw.line("%s is a file of length %d" % (
+                            key, p.size()))
+        elif size is None:
+            tw.line("%s/" % (name,))
+        else:
+            tw.line("%s/: %d bytes" % (name, size))
+
+    if config.getvalue("flakyreport"):
+        history = OutcomeHistory(config.cache.get("cache/outcomes", {}))
+        _flakyreport(tw.sep, tw.line, history)
+
+    n = config.option.cacheslowest
+    if n:
+        history = DurationHistory(config.cache.get("cache/durations", {}))
+        tw.sep("-", "slowest %d tests (mean of the last %d runs)" % (
+               n, DurationHistory.size))
+        for duration, nodeid in history.slowest(n):
+            tw.line("%8.2fs %s" % (duration, nodeid))
+
+
+def _globprefix(pattern):
+    """ return the literal part of ``pattern`` before any wildcard. """
+    for i, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:i]
+    return pattern
+
+
+def _keymatches(key, pattern):
+    if _globprefix(pattern) == pattern:
+        return key.startswith(pattern)
+    import fnmatch
+    return fnmatch.fnmatchcase(key, pattern)
+
+
+def _valueinfo(store, key):
+    """ return size, codec and modification time of the value for
+    ``key``, reading only its header. """
+    location = store.locate(key)
+    if location is None:
+        return None
+    path, offset, length = location
+    f = path.open("rb")
+    try:
+        f.seek(offset)
+        head = f.read(min(length, len(_valuemagic) + 2))
+    finally:
+        f.close()
+    try:
+        codec = peekcodec(head)[0].name
+    except ValueError:
+        codec = "unknown"
+    return {"key": key, "size": length, "codec": codec,
+            "mtime": store.mtime(key)}
+
+
+def _formattime(timestamp):
+    if timestamp is None:
+        return "unknown mtime"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def _jsonline(obj):
+    import json
+    return json.dumps(obj, sort_keys=True)
 
 
 ### XXX consider shifting part of the below to pytest config object
 
+def getnamespace(config):
+    """ return the cache namespace name for the running interpreter and
+    the ``--cache-env`` option or ``cache_env`` ini setting. """
+    implementation = getattr(sys, "implementation", None)
+    if implementation is not None:
+        name = implementation.name
+    elif "__pypy__" in sys.builtin_module_names:
+        name = "pypy"
+    elif sys.platform.startswith("java"):
+        name = "jython"
+    else:
+        name = "cpython"
+    name = "%s-%d.%d" % ((name,) + tuple(sys.version_info[:2]))
+    env = config.getvalue("cacheenv") or config.getini("cache_env")
+    if env:
+        for char in "/\\:":
+            env = env.replace(char, "_")
+        name += "-" + env
+    return name
+
+
 def getrootdir(config, name):
     """ return a best-effort root subdir for this test run.
 
@@ -223,13 +3721,117 @@ def getrootdir(config, name):
 
 
 def getroot(args, inibasenames):
+    """ yield the files named one of ``inibasenames`` found in the
+    directories of ``args`` and their ancestors, nearest first.
+
+    Each directory is looked at once: the search for an argument stops
+    at the first ancestor already searched for an earlier one, so many
+    arguments below a common directory cost little more than one.
+    """
     args = [x for x in args if not str(x).startswith("-")]
     if not args:
         args = [py.path.local()]
+    seen = set()
     for arg in args:
-        arg = py.path.local(arg)
-        for base in arg.parts(reverse=True):
+        path = os.path.abspath(str(arg))
+        while path not in seen:
+            seen.add(path)
             for inibasename in inibasenames:
-                p = base.join(inibasename)
-                if p.check():
-                    yield p
+                p = os.path.join(path, inibasename)
+                if os.path.exists(p):
+                    yield py.path.local(p)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+
+### reference cache server
+
+def makeserver(directory, host="127.0.0.1", port=0):
+    """ return an HTTP server keeping the values pushed by
+    ``cache_remote`` clients below ``directory``; call its
+    ``serve_forever()`` method to run it.  Each URL path is a separate
+    namespace, so several projects can share a server. """
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    directory = py.path.local(directory)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            namespace, _, op = self.path.rpartition("/")
+            parts = [x for x in namespace.split("/") if x]
+            try:
+                items = _unpackrecords(body)
+                for key, data in items:
+                    _checkremotekey(key)
+                if [x for x in parts if x in (".", "..")]:
+                    raise ValueError(namespace)
+            except ValueError:
+                return self._reply(400)
+            store = DirectoryStore(directory.join(*(parts + ["v"])),
+                                   directory.join("tmp"))
+            if op == "get":
+                self._reply(200, _packrecords(
+                    [(key, store.read(key)) for key, data in items]))
+            elif op == "put":
+                for key, data in items:
+                    if data is None:
+                        store.delete(key)
+                    else:
+                        store.write(key, data)
+                self._reply(204)
+            else:
+                self._reply(404)
+
+        def _reply(self, status, body=b""):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    return Server((host, port), Handler)
+
+
+def _checkremotekey(key):
+    parts = key.split("/")
+    if len(parts) < 2 or [x for x in parts if x in ("", ".", "..")]:
+        raise ValueError("invalid key %r" % (key,))
+
+
+def main(args=None):
+    """ run the reference cache server. """
+    import optparse
+    parser = optparse.OptionParser(
+        usage="python -m pytest_cache [--host HOST] [--port PORT] DIRECTORY",
+        description="serve cache values to pytest-cache clients whose "
+                    "cache_remote ini option points to this server")
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=8765)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("expected the storage DIRECTORY")
+    server = makeserver(args[0], options.host, options.port)
+    sys.stdout.write("serving %s on http://%s:%d/\n" % (
+        args[0], options.host, server.server_address[1]))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import pytest
 import py
 from textwrap import dedent
+from pytest_cache import Cache, peekcodec, getroot
 
 pytest_plugins = "pytester",
 
@@ -19,6 +20,24 @@ def test_cache_reportheader(testdir):
         "cachedir: %s" % cachedir,
     ])
 
+def test_getroot_nearest_first(tmpdir):
+    tmpdir.ensure("tox.ini")
+    sub = tmpdir.ensure("a", "b", dir=1)
+    sub.ensure("setup.py")
+    args = ["-x", sub.join("test_x.py"), tmpdir.join("a", "test_y.py")]
+    found = list(getroot(args, ["setup.py", "tox.ini"]))
+    assert found[0] == sub.join("setup.py")
+    assert found.count(tmpdir.join("tox.ini")) == 1
+
+def test_getroot_looks_at_directories_once(tmpdir, monkeypatch):
+    import os
+    deep = tmpdir.join(*["d%d" % i for i in range(10)])
+    args = [deep.join("test_%d.py" % i) for i in range(20)]
+    looked = []
+    monkeypatch.setattr(os.path, "exists", looked.append)
+    assert not list(getroot(args, ["setup.py", "tox.ini"]))
+    assert len(looked) == len(set(looked)) == 2 * (20 + len(deep.parts()))
+
 def test_cache_show(testdir):
     result = testdir.runpytest("--cache")
     assert result.ret == 0
@@ -35,7 +54,7 @@ def test_cache_show(testdir):
     """)
     result = testdir.runpytest()
     assert result.ret == 0
-    result = testdir.runpytest("--cache")
+    result = testdir.runpytest("--cache", "--cache-values")
     result.stdout.fnmatch_lines_random([
         "*cachedir:*",
         "-*cache values*-",
@@ -48,6 +67,100 @@ def test_cache_show(testdir):
         "*mydb/world*length 0*",
     ])
 
+def test_cache_show_metadata(testdir):
+    testdir.makeconftest("""
+        def pytest_configure(config):
+            config.cache.set("my/name", [1,2,3])
+            config.cache.set("my/other", "x")
+            config.cache.set("other/some", {1:2})
+            config.cache.makedir("mydb").ensure("hello")
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 0
+    result = testdir.runpytest("--cache", "--cache-filter=my/")
+    result.stdout.fnmatch_lines([
+        "-*cache values*-",
+        "my/name: * bytes, execnet, *",
+        "my/other: * bytes, execnet, *",
+        "-*cache directories*-",
+        "mydb/*",
+    ])
+    assert "other/some" not in result.stdout.str()
+    assert "contains" not in result.stdout.str()
+    result = testdir.runpytest("--cache", "--cache-filter=*/n*")
+    assert "my/name:" in result.stdout.str()
+    assert "my/other" not in result.stdout.str()
+    assert "mydb" not in result.stdout.str()
+
+def test_cache_show_json(testdir):
+    import json
+    testdir.makeconftest("""
+        def pytest_configure(config):
+            config.cache.set("my/name", [1,2,3])
+            config.cache.set("other/some", "x")
+            config.cache.makedir("mydb").ensure("hello")
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 0
+    result = testdir.runpytest("--cache", "--cache-json", "--cache-values")
+    objs = [json.loads(line) for line in result.stdout.lines
+            if line.startswith("{")]
+    assert objs[0]["key"] == "my/name"
+    assert objs[0]["value"] == [1, 2, 3]
+    assert objs[0]["codec"] == "execnet"
+    assert objs[0]["size"] > 0 and objs[0]["mtime"]
+    assert objs[1]["key"] == "other/some"
+    assert objs[2]["dir"] == "mydb"
+    assert objs[2]["files"] == {"mydb/hello": 0}
+
+def test_cache_stats(testdir):
+    import json
+    testdir.makeconftest("""
+        def pytest_configure(config):
+            config.cache.get("my/name", None)
+            config.cache.set("my/name", [1, 2, 3])
+    """)
+    testdir.makepyfile("""
+        def test_hello():
+            pass
+    """)
+    path = testdir.tmpdir.join("stats.json")
+    result = testdir.runpytest("--cache-stats", "--cache-stats-json",
+                               str(path))
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        "*cache stats*",
+        "prefix*hits*misses*",
+        "my *0 *1 *0*",
+    ])
+    stats = json.loads(path.read())["prefixes"]
+    assert stats["my"]["misses"] == 1
+    assert stats["my"]["bytes_written"] > 0
+    assert stats["cache"]["bytes_written"] > 0
+
+def test_cache_prune(testdir):
+    testdir.makeini("[pytest]")
+    config = testdir.parseconfigure()
+    config.cache.set("my/old", "x" * 1500)
+    config.cache.set("my/gone", 1, ttl=-1)
+    config.cache.flush()
+    config = testdir.parseconfigure()
+    config.cache.set("my/new", "y" * 1500)
+    config.cache.flush()
+    testdir.makeini("""
+        [pytest]
+        cache_maxsize = 2K
+    """)
+    result = testdir.runpytest("--cache-prune")
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        "removed value my/old*",
+        "removed value my/gone*",
+        "pruned 2 cache entries*",
+    ])
+    config = testdir.parseconfigure()
+    assert config.cache._store.keys() == ["my/new"]
+
 
 class TestNewAPI:
     def test_config_cache_makedir(self, testdir):
@@ -64,10 +177,500 @@ class TestNewAPI:
         cache = config.cache
         pytest.raises(ValueError, lambda: cache.set("key/name", cache))
         config.cache.set("key/name", 0)
+        config.cache.flush()
         config.cache._getvaluepath("key/name").write("123")
-        val = config.cache.get("key/name", -2)
+        assert config.cache.get("key/name", -2) == 0
+        val = Cache(config).get("key/name", -2)
         assert val == -2
 
+    def test_config_cache_lazy(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        cache = config.cache
+        assert cache._cachedirpath is None
+        assert cache._codec is None
+        assert cache.get("my/name", None) is None
+        assert cache._cachedirpath == testdir.tmpdir.join(".cache")
+        cache.set("my/name", 1)
+        assert cache._codec is not None
+
+    @pytest.mark.parametrize("codec", ["execnet", "marshal", "json"])
+    def test_config_cache_codec(self, testdir, codec):
+        testdir.makeini("""
+            [pytest]
+            cache_codec = %s
+        """ % codec)
+        config = testdir.parseconfigure()
+        value = {"a": [1, 2], "b": (3, None)}
+        nodeids = set(["test_a.py::test_1", "test_a.py::test_2"])
+        config.cache.set("my/name", value)
+        config.cache.set("my/nodeids", nodeids)
+        config.cache.flush()
+        data = config.cache._getvaluepath("my/name").read("rb")
+        assert peekcodec(data)[0].name == codec
+        data = config.cache._getvaluepath("my/nodeids").read("rb")
+        assert peekcodec(data)[0].name == "nodeids"
+        cache = Cache(config)
+        assert cache.get("my/name", None) == value
+        assert cache.get("my/nodeids", None) == nodeids
+
+    def test_config_cache_legacy_value(self, testdir):
+        import execnet
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        config.cache._getvaluepath("my/name").write(execnet.dumps([1]), "wb")
+        assert config.cache.get("my/name", None) == [1]
+
+    @pytest.mark.parametrize("backend", ["dir", "log"])
+    def test_config_cache_openwriter(self, testdir, backend):
+        testdir.makeini("""
+            [pytest]
+            cache_backend = %s
+        """ % backend)
+        config = testdir.parseconfigure()
+        cache = config.cache
+        writer = cache.openwriter("my/blob")
+        writer.write(b"hello ")
+        writer.write(b"world")
+        assert cache.openbuffer("my/blob") is None
+        writer.close()
+        assert bytes(cache.openbuffer("my/blob")) == b"hello world"
+        assert cache.get("my/blob", None) == b"hello world"
+        try:
+            with cache.openwriter("my/blob") as writer:
+                writer.write(b"garbage")
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        assert bytes(Cache(config).openbuffer("my/blob")) == b"hello world"
+        cache.set("my/value", 1)
+        pytest.raises(ValueError, lambda: cache.openbuffer("my/value"))
+
+    def test_config_cache_blobs(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        cache = config.cache
+        p = testdir.tmpdir.join("dump")
+        p.write(b"x" * 5000, "wb")
+        digest = cache.putblob(p)
+        from io import BytesIO
+        assert cache.putblob(BytesIO(b"x" * 5000)) == digest
+        assert cache.getblob(digest).read("rb") == b"x" * 5000
+        assert cache.getblob("0" * 40) is None
+        target = cache.linkblob(digest, testdir.tmpdir.join("a", "dump"))
+        assert target.read("rb") == b"x" * 5000
+        copy = cache.linkblob(digest, testdir.tmpdir.join("copy"),
+                              writable=True)
+        copy.write(b"y", "wb")
+        assert cache.getblob(digest).read("rb") == b"x" * 5000
+        pytest.raises(ValueError, lambda: cache.getblob("../../x"))
+
+    def test_config_cache_tree(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        src = testdir.mkdir("src")
+        src.ensure("a.txt").write("a")
+        src.ensure("sub", "b.txt").write("b")
+        digest = config.cache.puttree(src)
+        src.remove()
+        target = config.cache.linktree(digest, testdir.tmpdir.join("dst"))
+        assert target.join("a.txt").read() == "a"
+        assert target.join("sub", "b.txt").read() == "b"
+        blob = config.cache.putblob(target.join("a.txt"))
+        pytest.raises(ValueError, lambda: config.cache.linktree(blob, src))
+
+    def test_config_cache_mapfile(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        p = config.cache.makedir("mydb").join("dump")
+        p.write(b"x" * 5000, "wb")
+        assert bytes(config.cache.mapfile(p)) == b"x" * 5000
+        pytest.raises(ValueError, lambda: config.cache.mapfile(
+            testdir.tmpdir.join("test_x.py")))
+
+    @pytest.mark.parametrize("backend", ["dir", "log"])
+    def test_config_cache_update(self, testdir, backend):
+        testdir.makeini("""
+            [pytest]
+            cache_backend = %s
+        """ % backend)
+        config = testdir.parseconfigure()
+        other = Cache(config)
+
+        def incr(value):
+            return value + 1
+        assert config.cache.update("my/count", incr, 0) == 1
+        assert other.update("my/count", incr, 0) == 2
+        assert config.cache.update("my/count", incr, 0) == 3
+        assert config.cache.get("my/count", None) == 3
+        other.update("my/failed", lambda old: old | set(["A"]), set())
+        config.cache.update("my/failed", lambda old: old | set(["B"]), set())
+        assert Cache(config).get("my/failed", None) == set(["A", "B"])
+        assert not config.cache._cachedir.join("tmp").listdir()
+
+    def test_config_cache_ttl(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        config.cache.set("my/short", 1, ttl=-1)
+        config.cache.set("my/long", 2, ttl=3600)
+        p = config.cache.makedir("mydb", ttl=-1)
+        p.ensure("hello")
+        config.cache.flush()
+        cache = Cache(config)
+        assert cache.get("my/short", None) is None
+        assert cache.get("my/long", None) == 2
+        assert not cache.makedir("mydb").listdir()
+
+    def test_config_cache_maxsize(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_maxsize = 3K
+        """)
+        config = testdir.parseconfigure()
+        config.cache.set("my/a", "a" * 1500)
+        config.cache.set("my/b", "b" * 1500)
+        config.cache.flush()
+        cache = Cache(config)
+        assert cache.get("my/a", None)
+        cache.set("my/c", "c" * 1500)
+        cache.flush()
+        assert sorted(cache._store.keys()) == ["my/a", "my/c"]
+        assert Cache(config).get("my/b", None) is None
+
+    def test_config_cache_namespaces(self, testdir):
+        import sys
+        testdir.makeini("""
+            [pytest]
+            cache_env = one
+        """)
+        config = testdir.parseconfigure()
+        assert config.cache.namespace.endswith(
+            "-%d.%d-one" % sys.version_info[:2])
+        config.cache.set("my/key", 1)
+        blob = testdir.tmpdir.join("blob.txt")
+        blob.write("content")
+        digest = config.cache.putblob(blob)
+        config.cache.makedir("mydb").ensure("hello")
+        config.cache.flush()
+        other = testdir.parseconfigure("--cache-env=two").cache
+        assert other.namespace.endswith("-two")
+        assert other.get("my/key", None) is None
+        assert not other.makedir("mydb").listdir()
+        assert other.getblob(digest).read() == "content"
+        other.set("my/key", 2)
+        other.flush()
+        other.clear()
+        assert other.getblob(digest)
+        assert Cache(config).get("my/key", None) == 1
+        assert config.cache.makedir("mydb").join("hello").check()
+
+    def test_prune_keeps_blobs_of_other_namespaces(self, testdir):
+        import time
+        from io import BytesIO
+        testdir.makeini("[pytest]")
+        a = testdir.parseconfigure("--cache-env=a").cache
+        b = testdir.parseconfigure("--cache-env=b").cache
+        c = testdir.parseconfigure("--cache-env=c").cache
+        blob_a = a.putblob(BytesIO(b"a" * 100))
+        a.set("my/a", "a" * 100)
+        a.flush()
+        time.sleep(0.01)
+        blob_b = b.putblob(BytesIO(b"b" * 100))
+        b.flush()
+        # c uses no blobs and the blobs fit the budget together
+        assert c.prune(250) == []
+        assert not c._readmeta()["blobs"]
+        assert a._blobpath(blob_a).check() and a._blobpath(blob_b).check()
+        # blob_a was just used by b, so a's pruning removes blob_b
+        time.sleep(0.01)
+        assert b.getblob(blob_a)
+        b.flush()
+        assert a.prune(150) == [("blobs", blob_b, 100)]
+        assert a._blobpath(blob_a).check()
+        assert a.get("my/a", None)
+
+    def test_config_cache_clear(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        cache = config.cache
+        for key in ("my/a", "my/sub/b", "myother/c", "other/d"):
+            cache.set(key, key)
+        cache.flush()
+        cache.set("my/unflushed", 1)
+        cache.makedir("mydb").ensure("hello")
+        cache.makedir("otherdb").ensure("hello")
+        cache.clear("my/")
+        assert cache.get("my/a", None) is None
+        assert cache.get("my/unflushed", None) is None
+        assert cache.get("myother/c", None) == "myother/c"
+        assert cache.makedir("mydb").join("hello").check()
+        cache.clear("my")
+        assert cache._store.keys() == ["other/d"]
+        assert not cache.makedir("mydb").listdir()
+        assert cache.makedir("otherdb").join("hello").check()
+        assert Cache(config).get("other/d", None) == "other/d"
+        cache.clear()
+        assert Cache(config).get("other/d", None) is None
+        assert not cache.makedir("otherdb").listdir()
+
+    def test_clearcache_prefix(self, testdir):
+        testdir.makeconftest("""
+            def pytest_configure(config):
+                config._seen = (config.cache.get("my/a", None),
+                                config.cache.get("other/b", None))
+                config.cache.set("my/a", 1)
+                config.cache.set("other/b", 2)
+            def pytest_report_header(config):
+                return "seen: %r" % (config._seen,)
+        """)
+        testdir.makepyfile("""
+            def test_fail():
+                assert 0
+        """)
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["seen: (None, None)", "*1 failed*"])
+        result = testdir.runpytest("--clearcache-prefix=my/")
+        result.stdout.fnmatch_lines(["seen: (None, 2)", "*1 failed*"])
+        result = testdir.runpytest("--lf", "--clearcache-prefix=my/,x/")
+        result.stdout.fnmatch_lines_random([
+            "*rerun last 1 failures*",
+            "seen: (None, 2)",
+            "*1 failed*",
+        ])
+        result = testdir.runpytest("--lf",
+                                   "--clearcache-prefix=cache/lastfailed")
+        result.stdout.fnmatch_lines_random([
+            "*run all (no recorded failures)*",
+            "seen: (1, 2)",
+        ])
+
+    def test_clearcache_keeps_values_set_in_configure(self, testdir):
+        testdir.makeconftest("""
+            def pytest_configure(config):
+                config.cache.set("my/a", 42)
+                config.cache.makedir("foo")
+        """)
+        testdir.makepyfile("""
+            def test_value(pytestconfig):
+                assert pytestconfig.cache.get("my/a", None) == 42
+        """)
+        result = testdir.runpytest("--clearcache")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+        config = testdir.parseconfigure()
+        assert config.cache.get("my/a", None) == 42
+
+    def test_config_cache_memoize(self, testdir):
+        testdir.makeini("[pytest]")
+        dep = testdir.tmpdir.join("data.txt")
+        dep.write("1")
+        config = testdir.parseconfigure()
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+        memo = config.cache.memoize("my/square", deps=["data.txt"])(square)
+        assert memo(3) == 9
+        assert memo(3) == 9
+        assert memo(4) == 16
+        assert calls == [3, 4]
+        other = Cache(config).memoize("my/square", deps=["data.txt"])(square)
+        assert other(3) == 9
+        assert calls == [3, 4]
+        dep.write("2")
+        assert other(3) == 9
+        assert calls == [3, 4, 3]
+        assert config.cache._memostats == {"my/square": [1, 2]}
+
+    def test_memoize_digest_ignores_hash_order(self, testdir):
+        import os
+        import subprocess
+        import sys
+        import pytest_cache
+        script = testdir.makepyfile(digest="""
+            import hashlib, sys
+            from pytest_cache import ExecnetCodec, _canonical, encodevalue
+            value = ([set("abcdefghijklmnop")],
+                     {"x": frozenset([1, "a", (2,)]), "y": {}})
+            data = encodevalue(_canonical(value), ExecnetCodec)
+            sys.stdout.write(hashlib.sha1(data).hexdigest())
+        """)
+        path = os.path.dirname(pytest_cache.__file__)
+        digests = set()
+        for seed in "1", "2", "3":
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=path)
+            digests.add(subprocess.check_output(
+                [sys.executable, str(script)], env=env))
+        assert len(digests) == 1
+
+    def test_memoize_funcarg(self, testdir):
+        testdir.makeconftest("""
+            from pytest_cache import memoize_funcarg
+
+            @memoize_funcarg("my/data")
+            def pytest_funcarg__data(request):
+                return [42]
+        """)
+        testdir.makepyfile("""
+            def test_1(data):
+                assert data == [42]
+            def test_2(data):
+                assert data == [42]
+        """)
+        result = testdir.runpytest()
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(["*memoize*", "my/data: 0 hits, 1 misses"])
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["my/data: 1 hits, 0 misses"])
+
+    def test_config_cache_writeback(self, testdir):
+        testdir.makeini("[pytest]")
+        config = testdir.parseconfigure()
+        cache = config.cache
+        value = [1, 2]
+        cache.set("my/name", value)
+        value.append(3)
+        assert not cache._getvaluepath("my/name").check()
+        assert cache.get("my/name", None) == [1, 2]
+        cache.get("my/name", None).append(4)
+        assert cache.get("my/name", None) == [1, 2]
+        cache.flush()
+        assert cache._getvaluepath("my/name").check()
+        assert Cache(config).get("my/name", None) == [1, 2]
+
+    def test_config_cache_flush_at_sessionfinish(self, testdir):
+        testdir.makeconftest("""
+            def pytest_configure(config):
+                config.cache.set("my/name", 42)
+        """)
+        testdir.makepyfile("""
+            def test_hello(pytestconfig):
+                path = pytestconfig.cache._getvaluepath("my/name")
+                assert not path.check()
+        """)
+        result = testdir.runpytest()
+        assert result.ret == 0
+        config = testdir.parseconfigure()
+        assert config.cache.get("my/name", None) == 42
+
+    def test_config_cache_logbackend(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_backend = log
+        """)
+        config = testdir.parseconfigure()
+        config.cache.set("my/name", [1, 2])
+        config.cache.set("my/other", 3)
+        config.cache.set("my/name", [3])
+        cachedir = config.cache._envdir
+        assert cachedir.join("values.log").check()
+        assert not cachedir.join("v").check()
+        config = testdir.parseconfigure()
+        assert config.cache._store.keys() == ["my/name", "my/other"]
+        assert config.cache.get("my/name", None) == [3]
+
+    def test_config_cache_background_writer(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_writer = thread
+        """)
+        config = testdir.parseconfigure()
+        for i in range(100):
+            config.cache.set("my/name", i)
+        assert config.cache.get("my/name", None) == 99
+        config.cache._writer.drain()
+        assert Cache(config).get("my/name", None) == 99
+        config.cache.set("my/other", 1)
+        config.cache.flush()
+        assert not config.cache._writer._pending
+        assert Cache(config).get("my/other", None) == 1
+
+    def test_background_writer_flush_timeout(self, testdir, monkeypatch):
+        import threading
+        import time
+        from pytest_cache import BackgroundWriter
+        testdir.makeini("""
+            [pytest]
+            cache_writer = thread
+        """)
+        release = threading.Event()
+        write = BackgroundWriter._write
+        def slowwrite(self, pending):
+            release.wait()
+            write(self, pending)
+        monkeypatch.setattr(BackgroundWriter, "_write", slowwrite)
+        config = testdir.parseconfigure()
+        config.cache.set("my/name", 1)
+        start = time.time()
+        assert config.cache.flush(timeout=0.1) == ["my/name"]
+        assert time.time() - start < 5
+        assert not config.cache._writer._pending
+        release.set()
+        assert config.cache.flush() == []
+
+    def test_stuck_background_writer_at_exit(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_writer = thread
+        """)
+        conftest = testdir.makeconftest("""
+            import threading
+            import pytest
+            import pytest_cache
+
+            def pytest_configure(config):
+                writer = pytest_cache.BackgroundWriter
+                config._saved = writer.timeout, writer._write
+                block = threading.Event()
+                writer.timeout = 0.2
+                writer._write = lambda self, pending: block.wait()
+
+            @pytest.mark.trylast
+            def pytest_unconfigure(config):
+                writer = pytest_cache.BackgroundWriter
+                writer.timeout, writer._write = config._saved
+        """)
+        testdir.makepyfile("""
+            def test_1():
+                assert 0
+        """)
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines([
+            "*1 failed*",
+            "WARNING: cache-writer busy after 0.2s, dropped writes of: "
+            "*cache/lastfailed*",
+        ])
+        # the journal is kept, so the failure is not lost
+        config = testdir.parseconfigure()
+        assert config.cache._envdir.join("journal").listdir()
+        conftest.remove()
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*rerun last 1 failures*"])
+
+    def test_lastfailed_with_background_writer(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_writer = thread
+        """)
+        testdir.makepyfile("""
+            def test_1():
+                assert 0
+            def test_2():
+                pass
+        """)
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["*1 failed*1 passed*"])
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*1 failed*1 desel*"])
+
+    def test_config_cache_unknown_backend(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_backend = xyz
+        """)
+        result = testdir.runpytest()
+        result.stderr.fnmatch_lines(["*unknown cache_backend*xyz*"])
+
     def test_config_cache(self, testdir):
         testdir.makeconftest("""
             def pytest_configure(config):
@@ -97,6 +700,194 @@ class TestNewAPI:
         assert result.ret == 0
         result.stdout.fnmatch_lines(["*1 passed*"])
 
+class TestXdist:
+    def test_slaves_share_cache(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makeconftest("""
+            def pytest_configure(config):
+                if not hasattr(config, "slaveinput"):
+                    config.cache.set("my/master", 42)
+        """)
+        testdir.makepyfile("""
+            import pytest
+            @pytest.mark.parametrize("i", range(4))
+            def test_slave(pytestconfig, i):
+                assert pytestconfig.cache.get("my/master", None) == 42
+                pytestconfig.cache.set("my/slave%d" % i, i)
+                assert not pytestconfig.cache._envdir.join(
+                    "v", "my", "slave%d" % i).check()
+        """)
+        result = testdir.runpytest("-n2")
+        assert result.ret == 0
+        config = testdir.parseconfigure()
+        values = [config.cache.get("my/slave%d" % i, None) for i in range(4)]
+        assert values == [0, 1, 2, 3]
+
+    def test_snapshot_is_bounded(self, testdir):
+        config = testdir.parseconfigure()
+        config.cache.set("cache/lastfailed", set(["test_a.py::test_a"]))
+        config.cache.set("cache/mtimes", {"test_a.py": 1.0})
+        config.cache.set("cache/durations", {"x": "y" * 200})
+        config.cache.set("my/other", 1)
+        snapshot = config.cache._getsnapshot(
+            ["cache/lastfailed", "cache/mtimes", "cache/durations"],
+            maxsize=150, maxtotal=200)
+        assert sorted(snapshot) == ["cache/lastfailed", "cache/mtimes"]
+        # everything else was flushed for the slaves to read from disk
+        assert Cache(config).get("my/other", None) == 1
+        maxtotal = len(snapshot["cache/lastfailed"])
+        snapshot = config.cache._getsnapshot(
+            ["cache/lastfailed", "cache/mtimes"], 150, maxtotal)
+        assert list(snapshot) == ["cache/lastfailed"]
+
+    def test_master_reads_merged_values(self, testdir):
+        config = testdir.parseconfigure()
+        config.cache.set("my/a", [1])
+        config.cache.flush()
+        assert config.cache.get("my/a", None) == [1]
+        data = config.cache._encode("my/a", [2])
+        config.cache._mergeslave({"cache_updates": {"my/a": data}})
+        assert config.cache.get("my/a", None) == [2]
+        assert config.cache.update("my/a", lambda v: v + [3], []) == [2, 3]
+        config.cache.flush()
+        assert Cache(config).get("my/a", None) == [2, 3]
+
+    def test_memoize_single_flight(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile("""
+            import os, pytest
+            @pytest.mark.parametrize("i", range(4))
+            def test_slave(pytestconfig, i):
+                @pytestconfig.cache.memoize("my/value")
+                def compute():
+                    marker = pytestconfig.cache.makedir("calls")
+                    marker.ensure(str(os.getpid()))
+                    return 42
+                assert compute() == 42
+        """)
+        result = testdir.runpytest("-n2")
+        assert result.ret == 0
+        result.stdout.fnmatch_lines(["my/value: 3 hits, 1 misses"])
+        config = testdir.parseconfigure()
+        assert len(config.cache.makedir("calls").listdir()) == 1
+
+    def test_lastfailed_with_slaves(self, testdir):
+        pytest.importorskip("xdist")
+        testdir.makepyfile("""
+            import pytest
+            @pytest.mark.parametrize("i", range(4))
+            def test_num(i):
+                assert i != 2
+        """)
+        result = testdir.runpytest("-n2")
+        result.stdout.fnmatch_lines(["*1 failed*3 passed*"])
+        result = testdir.runpytest("-n2", "--lf")
+        result.stdout.fnmatch_lines(["*1 failed*"])
+        assert "passed" not in result.stdout.lines[-1]
+
+
+def pytest_funcarg__remote(request):
+    import threading
+    from pytest_cache import makeserver
+    tmpdir = request.getfuncargvalue("tmpdir")
+    server = makeserver(tmpdir.join("server"))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return "http://127.0.0.1:%d/myproject" % (server.server_address[1],)
+
+
+class TestRemote:
+    def test_values_are_shared(self, testdir, remote):
+        testdir.makeini("""
+            [pytest]
+            cache_remote = %s
+        """ % remote)
+        config = testdir.parseconfigure()
+        config.cache.set("my/name", [1, 2])
+        config.cache.flush()
+        assert config.cache._store.wait()
+        config.cache._cachedir.remove()
+        cache = Cache(config)
+        assert cache.get("my/name", None) == [1, 2]
+        assert cache._store.local.read("my/name") is not None
+
+    def test_prune_and_delete_stay_local(self, testdir, remote):
+        testdir.makeini("""
+            [pytest]
+            cache_remote = %s
+        """ % remote)
+        config = testdir.parseconfigure()
+        config.cache.set("my/a", "a" * 1500)
+        config.cache.set("my/b", 1)
+        config.cache.flush()
+        config.cache.prune(10)
+        assert config.cache._store.local.read("my/a") is None
+        assert config.cache._store.wait()
+        config.cache._cachedir.remove()
+        fresh = Cache(config)
+        assert fresh.get("my/a", None) == "a" * 1500
+        fresh.deleteremote(["my/a"])
+        assert fresh.get("my/a", None) is None
+        assert fresh._store.wait()
+        config.cache._cachedir.remove()
+        fresh = Cache(config)
+        assert fresh.get("my/a", None) is None
+        assert fresh.get("my/b", None) == 1
+
+    def test_clearing_is_local(self, testdir, remote):
+        testdir.makeini("""
+            [pytest]
+            cache_remote = %s
+        """ % remote)
+        config = testdir.parseconfigure()
+        config.cache.set("my/a", 1)
+        config.cache.set("other/b", 2)
+        config.cache.flush()
+        assert config.cache._store.wait()
+        cache = testdir.parseconfigure("--clearcache").cache
+        assert cache.get("my/a", None) is None
+        assert cache.get("other/b", None) is None
+        cache = testdir.parseconfigure("--clearcache-prefix=my/").cache
+        assert cache.get("my/a", None) is None
+        assert cache.get("other/b", None) == 2
+        assert cache._store.wait()
+        # the server still has all values for other machines
+        config.cache._cachedir.remove()
+        cache = Cache(config)
+        assert cache.get("my/a", None) == 1
+        assert cache.get("other/b", None) == 2
+
+    def test_lastfailed_on_fresh_checkout(self, testdir, remote):
+        testdir.makeini("""
+            [pytest]
+            cache_remote = %s
+        """ % remote)
+        testdir.makepyfile("""
+            def test_1():
+                assert 0
+            def test_2():
+                pass
+        """)
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["*1 failed*1 passed*"])
+        testdir.tmpdir.join(".cache").remove()
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*1 failed*1 desel*"])
+
+    def test_unreachable_server(self, testdir):
+        testdir.makeini("""
+            [pytest]
+            cache_remote = http://127.0.0.1:1/myproject
+        """)
+        config = testdir.parseconfigure()
+        assert config.cache.get("my/name", 42) == 42
+        config.cache.set("my/name", 1)
+        config.cache.flush()
+        assert Cache(config).get("my/name", None) == 1
+
+
 class TestLastFailed:
     @pytest.mark.skipif("sys.version_info < (2,6)")
     def test_lastfailed_usecase(self, testdir, monkeypatch):
@@ -136,6 +927,45 @@ class TestLastFailed:
             "*1 failed*2 passed*",
         ])
 
+    def test_lastfailed_forgets_removed_tests(self, testdir, monkeypatch):
+        monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
+        p = testdir.makepyfile("""
+            def test_old():
+                assert 0
+            def test_other():
+                assert 0
+        """)
+        testdir.runpytest()
+        p.write(py.code.Source("""
+            def test_new():
+                pass
+            def test_other():
+                assert 0
+        """))
+        testdir.runpytest("%s::test_new" % p.basename)
+        config = testdir.parseconfigure()
+        assert len(config.cache.get("cache/lastfailed", None)) == 2
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["*1 failed*1 passed*"])
+        config = testdir.parseconfigure()
+        assert config.cache.get("cache/lastfailed", None) == set(
+            ["%s::test_other" % p.basename])
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines([
+            "*rerun last 1 failures*",
+            "*1 failed*1 deselected*",
+        ])
+        p.write(py.code.Source("""
+            def test_new():
+                pass
+            def test_renamed():
+                pass
+        """))
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["*2 passed*"])
+        config = testdir.parseconfigure()
+        assert config.cache.get("cache/lastfailed", None) == set()
+
     @pytest.mark.skipif("sys.version_info < (2,6)")
     def test_lastfailed_difference_invocations(self, testdir, monkeypatch):
         monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
@@ -197,6 +1027,175 @@ class TestLastFailed:
             "*2 failed*",
         ])
 
+    def test_lastfailed_merges_sessions(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                assert 0
+        """, test_b="""
+            def test_b1():
+                assert 0
+        """)
+        testdir.runpytest("test_a.py")
+        testdir.runpytest("test_b.py")
+        config = testdir.parseconfigure()
+        lastfailed = config.cache.get("cache/lastfailed", None)
+        assert lastfailed == set(["test_a.py::test_a1", "test_b.py::test_b1"])
+        testdir.tmpdir.join("test_a.py").write("def test_a1(): pass")
+        testdir.runpytest("test_a.py")
+        config = testdir.parseconfigure()
+        lastfailed = config.cache.get("cache/lastfailed", None)
+        assert lastfailed == set(["test_b.py::test_b1"])
+
+    def test_lastfailed_stale_failures(self, testdir):
+        p = testdir.makepyfile("""
+            def test_1():
+                assert 0
+        """)
+        testdir.runpytest()
+        p.write("def test_2(): pass")
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+
+    def test_lastfailed_skips_collection(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                assert 0
+        """, test_b="""
+            def test_b1():
+                pass
+        """)
+        result = testdir.runpytest()
+        result.stdout.fnmatch_lines(["*1 failed*1 passed*"])
+        testdir.tmpdir.join("test_b.py").write("raise ImportError")
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*1 failed*"])
+        assert "ImportError" not in result.stdout.str()
+        result = testdir.runpytest("--lf", "test_b.py")
+        result.stdout.fnmatch_lines(["*ImportError*"])
+
+    def test_lastfailed_missing_file_collects_all(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                assert 0
+        """, test_b="""
+            def test_b1():
+                pass
+        """)
+        testdir.runpytest()
+        testdir.tmpdir.join("test_a.py").remove()
+        result = testdir.runpytest("--lf")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+
+    def test_lastfailed_renamed_failure(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                assert 0
+            def test_a2():
+                pass
+        """, test_b="""
+            def test_b1():
+                pass
+        """)
+        testdir.runpytest()
+        testdir.tmpdir.join("test_a.py").write(dedent("""
+            def test_renamed():
+                assert 0
+            def test_a2():
+                pass
+        """))
+        result = testdir.runpytest("--lf", "-v")
+        result.stdout.fnmatch_lines([
+            "*rerun last 1 failures*",
+            "run-last-failure: recorded failures not found, running all "
+            "tests of their files",
+            "*1 failed*1 passed*",
+        ])
+        assert "test_b1" not in result.stdout.str()
+
+    def test_failedfirst_order(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                pass
+            def test_a2():
+                assert 0
+        """, test_b="""
+            def test_b1():
+                assert 0
+        """)
+        result = testdir.runpytest("-v")
+        result.stdout.fnmatch_lines([
+            "*test_a.py*test_a1 PASSED",
+            "*test_a.py*test_a2 FAILED",
+            "*test_b.py*test_b1 FAILED",
+        ])
+        result = testdir.runpytest("-v", "--ff")
+        result.stdout.fnmatch_lines([
+            "*run last 2 failures first*",
+            "*test_a.py*test_a2 FAILED",
+            "*test_b.py*test_b1 FAILED",
+            "*test_a.py*test_a1 PASSED",
+            "*2 failed*1 passed*",
+        ])
+
+    def test_newfirst_order(self, testdir):
+        testdir.makepyfile(test_a="""
+            def test_a1():
+                pass
+        """, test_b="""
+            def test_b1():
+                pass
+        """)
+        result = testdir.runpytest("-v")
+        result.stdout.fnmatch_lines([
+            "*test_a.py*test_a1 PASSED",
+            "*test_b.py*test_b1 PASSED",
+        ])
+        p = testdir.tmpdir.join("test_b.py")
+        p.write("def test_b1(): assert 0")
+        p.setmtime(p.mtime() + 10)
+        result = testdir.runpytest("-v", "--nf")
+        result.stdout.fnmatch_lines([
+            "*test_b.py*test_b1 FAILED",
+            "*test_a.py*test_a1 PASSED",
+        ])
+        testdir.tmpdir.join("test_c.py").write("def test_c1(): pass")
+        result = testdir.runpytest("-v", "--nf", "--ff")
+        result.stdout.fnmatch_lines([
+            "*test_b.py*test_b1 FAILED",
+            "*test_c.py*test_c1 PASSED",
+            "*test_a.py*test_a1 PASSED",
+        ])
+
+    def test_lastfailed_survives_crash(self, testdir):
+        testdir.makepyfile("""
+            import os
+            def test_1():
+                assert 0
+            def test_2():
+                os._exit(1)
+            def test_3():
+                pass
+        """)
+        testdir.runpytest()
+        journal = testdir.parseconfigure().cache._envdir.join("journal")
+        assert len(journal.listdir()) == 1
+        result = testdir.runpytest("--lf", "-k", "-test_2")
+        result.stdout.fnmatch_lines([
+            "*rerun last 1 failures*",
+            "*1 failed*",
+        ])
+        assert not journal.listdir()
+
+    def test_clear_keeps_live_journal(self, testdir):
+        from pytest_cache import OutcomeJournal
+        cache = testdir.parseconfigure().cache
+        journal = OutcomeJournal(cache)
+        journal.record("F", "test_a.py::test_a")
+        cache.clear()
+        assert len(cache._envdir.join("journal").listdir()) == 1
+        journal.close()
+        assert not cache._envdir.join("journal").listdir()
+
     def test_lastfailed_xpass(self, testdir):
         rep = testdir.inline_runsource1("""
             import pytest
@@ -207,3 +1206,221 @@ class TestLastFailed:
         config = testdir.parseconfigure()
         lastfailed = config.cache.get("cache/lastfailed", -1)
         assert not lastfailed
+
+
+class TestFlaky:
+    def test_outcome_history(self):
+        from pytest_cache import OutcomeHistory
+        history = OutcomeHistory({})
+        history.add({"a": [False, True, False], "b": [True, True, False],
+                     "c": [False] * 25 + [True]})
+        assert history.failures("a") == [False, True, False]
+        assert history.failures("b") == [True, True, False]
+        assert history.failures("c") == [False] * 19 + [True]
+        assert history.failures("d") == []
+        assert history.flaky() == [(2, 1 / 3.0, "a")]
+
+    def test_rerun_flaky(self, testdir):
+        testdir.makepyfile("""
+            import py
+            def test_flaky(tmpdir):
+                counter = py.path.local(%r)
+                n = int(counter.check() and counter.read() or 0)
+                counter.write(str(n + 1))
+                assert n %% 2 == 0
+            def test_broken():
+                assert 0
+        """ % str(testdir.tmpdir.join("counter")))
+        for i in range(3):
+            testdir.runpytest("--rerun-flaky=2")
+        result = testdir.runpytest("--rerun-flaky=2", "--flaky-report")
+        result.stdout.fnmatch_lines([
+            "*- rerun flaky tests -*",
+            "*::test_flaky: 1 reruns",
+            "*- flaky tests (failure rate over the last 20 runs) -*",
+            " 40.0%   4 flips  *::test_flaky",
+            "*1 failed*1 passed*",
+        ])
+        assert "test_broken: " not in result.stdout.str()
+        result = testdir.runpytest("--cache", "--flaky-report")
+        result.stdout.fnmatch_lines([
+            "*- flaky tests*",
+            " 40.0%   4 flips  *::test_flaky",
+        ])
+
+
+class TestDurations:
+    def test_durations_order(self, testdir):
+        testdir.makepyfile("""
+            import time
+            def test_fast():
+                pass
+            def test_slow():
+                time.sleep(0.2)
+        """)
+        result = testdir.runpytest("-v", "--durations-order")
+        result.stdout.fnmatch_lines([
+            "*test_fast PASSED",
+            "*test_slow PASSED",
+        ])
+        result = testdir.runpytest("-v", "--durations-order")
+        result.stdout.fnmatch_lines([
+            "*test_slow PASSED",
+            "*test_fast PASSED",
+        ])
+
+    def test_durations_history(self, testdir):
+        testdir.makepyfile("""
+            def test_hello():
+                pass
+        """)
+        for i in range(10):
+            testdir.runpytest()
+        config = testdir.parseconfigure()
+        from pytest_cache import DurationHistory
+        history = DurationHistory(config.cache.get("cache/durations", {}))
+        names, values = history._unpack("test_durations_history.py")
+        assert names == ["test_hello"]
+        assert len(values) == DurationHistory.size
+        assert list(history.means()) == [
+            "test_durations_history.py::test_hello"]
+
+    def test_cache_slowest(self, testdir):
+        testdir.makepyfile("""
+            import time
+            def test_fast():
+                pass
+            def test_slow():
+                time.sleep(0.1)
+        """)
+        testdir.runpytest()
+        result = testdir.runpytest("--cache", "--cache-slowest=1")
+        result.stdout.fnmatch_lines([
+            "*slowest 1 tests*",
+            "*s test_cache_slowest.py::test_slow",
+        ])
+        assert "test_fast" not in result.stdout.str().split("slowest 1")[1]
+
+
+class TestCollectCache:
+    def test_skips_unchanged_files(self, testdir):
+        testdir.makepyfile(test_a="""
+            import py
+            py.path.local(__file__).dirpath("imported").ensure()
+            def test_a1():
+                pass
+        """, test_b="""
+            import pytest
+            @pytest.mark.slow
+            def test_b1():
+                pass
+        """)
+        marker = testdir.tmpdir.join("imported")
+        result = testdir.runpytest("--collect-cache")
+        result.stdout.fnmatch_lines(["*2 passed*"])
+        assert marker.check()
+        marker.remove()
+        result = testdir.runpytest("--collect-cache", "-m", "slow")
+        result.stdout.fnmatch_lines([
+            "*skipped 1 unchanged files*",
+            "*1 passed*",
+        ])
+        assert not marker.check()
+        result = testdir.runpytest("--collect-cache", "-k", "a1")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+        assert marker.check()
+        marker.remove()
+        testdir.makeconftest("")
+        result = testdir.runpytest("--collect-cache", "-m", "slow")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+        assert marker.check()
+
+    def test_collection_errors_are_not_recorded(self, testdir):
+        testdir.makepyfile(test_a="""
+            import not_existing_module
+        """)
+        testdir.runpytest("--collect-cache")
+        config = testdir.parseconfigure()
+        assert config.cache.get("cache/collection", {}) == {}
+        result = testdir.runpytest("--collect-cache", "-k", "xyz")
+        result.stdout.fnmatch_lines(["*ImportError*"])
+
+
+class TestImpact:
+    def test_changed_runs_affected_tests(self, testdir, monkeypatch):
+        monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
+        testdir.makepyfile(mod_a="""
+            def f():
+                return 1
+        """, mod_b="""
+            def g():
+                return 2
+        """, test_x="""
+            import mod_a, mod_b
+            def test_a():
+                assert mod_a.f() == 1
+            def test_b():
+                assert mod_b.g() == 2
+        """)
+        result = testdir.runpytest("--record-impact")
+        result.stdout.fnmatch_lines(["*2 passed*"])
+        config = testdir.parseconfigure()
+        impact = config.cache.get("cache/impact", None)
+        assert impact["nodeids"] == ["test_x.py::test_a", "test_x.py::test_b"]
+        assert sorted(impact["files"]) == ["mod_a.py", "mod_b.py", "test_x.py"]
+        result = testdir.runpytest("--changed")
+        result.stdout.fnmatch_lines(["*2 deselected*"])
+        testdir.tmpdir.join("mod_a.py").write(py.code.Source("""
+            def f():
+                return 3
+        """))
+        result = testdir.runpytest("--changed", "-v")
+        result.stdout.fnmatch_lines([
+            "*test_a FAILED",
+            "*1 failed*1 deselected*",
+        ])
+        testdir.makepyfile(test_y="""
+            def test_new():
+                pass
+        """)
+        result = testdir.runpytest("--changed", "-v")
+        result.stdout.fnmatch_lines([
+            "*test_a FAILED",
+            "*test_new PASSED",
+            "*1 failed*1 passed*1 deselected*",
+        ])
+
+    def test_changed_after_partial_rerun(self, testdir, monkeypatch):
+        monkeypatch.setenv("PYTHONDONTWRITEBYTECODE", 1)
+        testdir.makepyfile(mod="""
+            def f():
+                return 1
+        """, test_x="""
+            import mod
+            def test_a():
+                assert mod.f()
+            def test_b():
+                assert mod.f() == 1
+        """)
+        result = testdir.runpytest("--record-impact")
+        result.stdout.fnmatch_lines(["*2 passed*"])
+        testdir.tmpdir.join("mod.py").write(py.code.Source("""
+            def f():
+                return 2
+        """))
+        result = testdir.runpytest("--record-impact", "-k", "test_a")
+        result.stdout.fnmatch_lines(["*1 passed*"])
+        # test_b did not run against the changed module yet
+        result = testdir.runpytest("--changed", "-v")
+        result.stdout.fnmatch_lines([
+            "*test_b FAILED",
+            "*1 failed*1 deselected*",
+        ])
+
+    def test_changed_without_recording_runs_all(self, testdir):
+        testdir.makepyfile("""
+            def test_hello():
+                pass
+        """)
+        result = testdir.runpytest("--changed")
+        result.stdout.fnmatch_lines(["*1 passed*"])